@@ -1,18 +1,246 @@
-import os
-from flask import Flask, request, jsonify, abort
-from flask_sqlalchemy import SQLAlchemy
-from flask_cors import CORS
+import hashlib
 import json
-from flask_migrate import Migrate
+import time
+from collections import Counter
+import click
+from flask import Flask, Response, current_app, request, jsonify, abort, stream_with_context
+from sqlalchemy import exc
+from sqlalchemy.orm import selectinload
+from flask_cors import CORS
 
-from models import setup_db, Character, Game, db
+from models import setup_db, pool_stats, paginate, paginate_ranked, stream, bulk_insert, delete_returning, update_if_version, is_int, Character, Game, db, BULK_BATCH_SIZE, MAX_BULK_ITEMS, DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE
 from auth.auth import AuthError, requires_auth
+from cache import setup_cache, cached, invalidates
+from changes import changes_since, prune as prune_changes, pruned_through, track_deletes, track_upserts, visible_entities, wait_for_changes, CHANGES_HEARTBEAT_SECONDS, CHANGES_STREAM_SECONDS, MAX_CHANGES_WAIT
+from idempotency import setup_idempotency, idempotent, prune as prune_idempotency_keys
+from ratelimit import setup_rate_limits, rate_limited
+from metrics import setup_metrics, render as render_metrics
+from write_behind import setup_write_behind, get_queue
+from serializers import dumps, json_response, row_dicts, select_fields
+from stats import counters, character_summary, forget_games, game_summary, rebuild, track_rows, CHARACTER_FIELDS, GAME_FIELDS
+
+
+def int_arg(name):
+  value = request.args.get(name)
+  if value is None:
+    return None
+  try:
+    return int(value)
+  except ValueError:
+    abort(400)
+
+
+def bool_arg(name):
+  value = request.args.get(name)
+  if value is None:
+    return None
+  if value.lower() in ('true', '1'):
+    return True
+  if value.lower() in ('false', '0'):
+    return False
+  abort(400)
+
+
+def page_args():
+  after = int_arg('cursor')
+  limit = int_arg('limit')
+  if limit is None:
+    limit = DEFAULT_PAGE_SIZE
+  if limit < 1 or limit > MAX_PAGE_SIZE:
+    abort(400)
+  return after, limit
+
+
+def search_args():
+  offset = int_arg('cursor') or 0
+  limit = int_arg('limit')
+  if limit is None:
+    limit = DEFAULT_PAGE_SIZE
+  if offset < 0 or limit < 1 or limit > MAX_PAGE_SIZE:
+    abort(400)
+
+  mode = request.args.get('mode', 'substring')
+  if mode not in ('prefix', 'substring'):
+    abort(400)
+
+  return request.args.get('q', '').strip(), mode == 'prefix', offset, limit
+
+
+def bulk_ids():
+  # {"ids": [1, 2, 3]} for the bulk deletes
+  body = request.get_json(silent=True)
+  ids = body.get('ids') if isinstance(body, dict) else None
+  if not isinstance(ids, list) or not ids or len(ids) > BULK_BATCH_SIZE or not all(is_int(id) for id in ids):
+    abort(400)
+  return sorted(set(ids))
+
+
+def cascade_arg():
+  cascade = bool_arg('cascade')
+  if cascade is None:
+    return current_app.config['DELETE_CASCADE']
+  return cascade
+
+
+def delete_games(ids, cascade):
+  # a single statement however many games (and characters) go
+  try:
+    games = Game.delete_many(ids, ('id', 'title') + GAME_FIELDS, cascade)
+  except exc.IntegrityError:
+    # some of the games still have characters
+    db.session.rollback()
+    abort(409)
+  track_rows(Game, games, -1)
+  forget_games(games)
+  track_deletes(Game, [game['id'] for game in games])
+  track_deletes(Character, [id for game in games for id in game['character_ids']])
+  db.session.commit()
+  return games
+
+
+def delete_characters(ids):
+  characters = delete_returning(Character, Character.id.in_(ids), ('id',) + CHARACTER_FIELDS)
+  track_rows(Character, characters, -1)
+  track_deletes(Character, [character['id'] for character in characters])
+  db.session.commit()
+  return characters
+
+
+def changes_args():
+  # since is the last seq the client has seen, also accepted as the SSE
+  # Last-Event-ID header on reconnects
+  since = int_arg('since')
+  if since is None:
+    last_event_id = request.headers.get('Last-Event-ID', '0')
+    if not last_event_id.isdigit():
+      abort(400)
+    since = int(last_event_id)
+  limit = int_arg('limit')
+  if limit is None:
+    limit = DEFAULT_PAGE_SIZE
+  if since < 0 or limit < 1 or limit > MAX_PAGE_SIZE:
+    abort(400)
+  if since < pruned_through():
+    # older changes are gone, the client has to download everything again
+    abort(410)
+  return since, limit
+
+
+def if_match_version():
+  # PATCH takes the game's version as If-Match ("3", W/"3" or 3), or the
+  # ETag of GET /games/<id> ("3-<hash>" with include=characters); no header
+  # or * updates whatever version is current
+  value = request.headers.get('If-Match')
+  if value is None or value.strip() == '*':
+    return None
+  value = value.strip()
+  if value.startswith('W/'):
+    value = value[2:]
+  value = value.strip('"').partition('-')[0]
+  if not value.isdigit():
+    abort(400)
+  return int(value)
+
+
+def include_characters():
+  include = request.args.get('include')
+  if include is None:
+    return False
+  if include != 'characters':
+    abort(400)
+  return True
+
+
+def wants_stream():
+  if request.args.get('stream') in ('1', 'true'):
+    return True
+  best = request.accept_mimetypes.best_match(['application/json', 'application/x-ndjson'])
+  return best == 'application/x-ndjson'
+
+
+def field_columns(model):
+  try:
+    return select_fields(model, request.args.get('fields'))
+  except ValueError:
+    abort(400)
+
+
+def ndjson_response(items):
+  def generate():
+    for item in items:
+      yield dumps(item) + b'\n'
+
+  return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+
+def bulk_items():
+  if request.mimetype == 'application/x-ndjson':
+    items = []
+    for line in request.get_data(as_text=True).splitlines():
+      if not line.strip():
+        continue
+      if len(items) == MAX_BULK_ITEMS:
+        abort(400)
+      try:
+        items.append(json.loads(line))
+      except ValueError:
+        abort(400)
+    return items
+
+  body = request.get_json(silent=True)
+  if not isinstance(body, list) or len(body) > MAX_BULK_ITEMS:
+    abort(400)
+  return body
+
+
+def validate_bulk(model, items):
+  rows = []
+  errors = []
+  for index, item in enumerate(items):
+    try:
+      rows.append((index, model.bulk_row(item)))
+    except ValueError as e:
+      errors.append({'index': index, 'error': str(e)})
+  return rows, errors
+
+
+def bulk_response(model, rows, errors):
+  # nothing is written unless every item is valid
+  if errors:
+    return jsonify({
+      'success': False,
+      'error': 400,
+      'message': 'bad request',
+      'results': sorted(errors, key=lambda error: error['index'])
+    }), 400
+
+  try:
+    items = [row for index, row in rows]
+    track_rows(model, items)
+    ids = bulk_insert(model, items, on_insert=lambda ids: track_upserts(
+      model, [dict(row, id=id) for row, id in zip(items, ids)]))
+  except (exc.IntegrityError, exc.DataError):
+    # e.g. a character whose game_id does not exist, or a value out of range
+    abort(400)
+
+  return jsonify({
+    'success': True,
+    'created': len(ids),
+    'results': [{'index': index, 'id': id} for (index, row), id in zip(rows, ids)]
+  })
 
 
 def create_app(test_config=None):
   # create and configure the app
   app = Flask(__name__)
+  if test_config is not None:
+    app.config.from_mapping(test_config)
   setup_db(app)
+  setup_cache(app)
+  setup_idempotency(app)
+  setup_rate_limits(app)
+  setup_write_behind(app)
+  setup_metrics(app)
   CORS(app)
 
   @app.after_request
@@ -23,30 +251,136 @@ def create_app(test_config=None):
 
   @app.route('/games', methods=['GET'])
   @requires_auth('get:games')
+  @rate_limited('list')
+  @cached('games', skip=wants_stream)
   def get_games(jwt):
-    games = Game.query.all()
+    after, limit = page_args()
+    query = Game.filtered(
+      genre=request.args.get('genre'),
+      completed=bool_arg('completed'),
+      min_rating=int_arg('min_rating'),
+      max_rating=int_arg('max_rating'))
+    include = include_characters()
+
+    if include:
+      if wants_stream() or 'fields' in request.args:
+        abort(400)
+      # one extra SELECT ... WHERE game_id IN (...) for the whole page
+      games, next_cursor = paginate(query.options(selectinload(Game.characters)), Game, after, limit)
+      list = [game.with_characters() for game in games]
+    else:
+      columns = field_columns(Game)
+      query = query.with_entities(*columns)
+
+      if wants_stream():
+        return ndjson_response(row_dicts(columns, stream(query, Game, after)))
+
+      games, next_cursor = paginate(query, Game, after, limit)
+      list = [game for game in row_dicts(columns, games)]
+
+    return json_response({
+      "success": True,
+      "games": list,
+      "next_cursor": next_cursor
+    })
 
-    list = [game.full() for game in games]
+  @app.route('/games/search', methods=['GET'])
+  @requires_auth('get:games')
+  @rate_limited('list')
+  @cached('games')
+  def search_games(jwt):
+    text, prefix, offset, limit = search_args()
+    genres = [genre for genre in request.args.get('genres', '').split(',') if genre]
+    if not text and not genres:
+      abort(400)
 
-    return jsonify({
+    columns = field_columns(Game)
+    query = Game.search(text, genres, prefix).with_entities(*columns)
+    games, next_cursor = paginate_ranked(query, offset, limit)
+
+    return json_response({
       "success": True,
-      "games": list
+      "games": [game for game in row_dicts(columns, games)],
+      "next_cursor": next_cursor
     })
 
+  @app.route('/games/<int:game_id>', methods=['GET'])
+  @requires_auth('get:games')
+  @rate_limited('list')
+  @cached('games')
+  def get_game(jwt, game_id):
+    include = include_characters()
+    query = Game.query
+    if include:
+      query = query.options(selectinload(Game.characters))
+
+    game = query.filter(Game.id==game_id).one_or_none()
+
+    if game is None:
+      abort(404)
+
+    response = jsonify({
+      "success": True,
+      "game": game.with_characters() if include else game.full()
+    })
+    # the version, which PATCH takes back as If-Match; with the characters
+    # the body can change while the version doesn't, so a hash is added
+    etag = str(game.version)
+    if include:
+      etag += '-' + hashlib.md5(response.get_data()).hexdigest()
+    response.set_etag(etag)
+    return response
+
   @app.route('/characters', methods=['GET'])
   @requires_auth('get:characters')
+  @rate_limited('list')
+  @cached('characters', skip=wants_stream)
   def get_characters(jwt):
-    characters = Character.query.all()
+    after, limit = page_args()
+    query = Character.filtered(
+      game_id=int_arg('game_id'),
+      good=bool_arg('good'))
 
-    list = [character.full() for character in characters]
+    columns = field_columns(Character)
+    query = query.with_entities(*columns)
 
-    return jsonify({
+    if wants_stream():
+      return ndjson_response(row_dicts(columns, stream(query, Character, after)))
+
+    characters, next_cursor = paginate(query, Character, after, limit)
+
+    list = [character for character in row_dicts(columns, characters)]
+
+    return json_response({
+      "success": True,
+      "characters": list,
+      "next_cursor": next_cursor
+    })
+
+  @app.route('/characters/search', methods=['GET'])
+  @requires_auth('get:characters')
+  @rate_limited('list')
+  @cached('characters')
+  def search_characters(jwt):
+    text, prefix, offset, limit = search_args()
+    if not text:
+      abort(400)
+
+    columns = field_columns(Character)
+    query = Character.search(text, int_arg('game_id'), prefix).with_entities(*columns)
+    characters, next_cursor = paginate_ranked(query, offset, limit)
+
+    return json_response({
       "success": True,
-      "characters": list
+      "characters": [character for character in row_dicts(columns, characters)],
+      "next_cursor": next_cursor
     })
 
   @app.route("/games/create", methods=["POST"])
   @requires_auth('post:games')
+  @rate_limited('write')
+  @idempotent
+  @invalidates('games')
   def post_game(jwt):
     body = request.get_json()
     try:
@@ -65,27 +399,53 @@ def create_app(test_config=None):
     except:
       abort(400)
 
+  @app.route("/games/bulk", methods=["POST"])
+  @requires_auth('post:games')
+  @rate_limited('write')
+  @idempotent
+  @invalidates('games')
+  def post_games_bulk(jwt):
+    rows, errors = validate_bulk(Game, bulk_items())
+    return bulk_response(Game, rows, errors)
+
   @app.route("/games/<int:game_id>", methods=['DELETE'])
   @requires_auth("delete:games")
+  @rate_limited('delete')
+  @invalidates('games', 'characters')
   def delete_game(jwt, game_id):
-    print("2")
-    game = Game.query.filter_by(id=game_id).first()
-    print("1")
+    games = delete_games([game_id], cascade_arg())
 
-    if game is None:
+    if not games:
       abort(404)
 
-    game.delete()
-    print("3")
+    return jsonify({
+      'success': True,
+      'game_id': game_id,
+      'title': games[0]['title'],
+      'characters_deleted': len(games[0]['character_ids'])
+    })
+
+  @app.route("/games", methods=['DELETE'])
+  @requires_auth("delete:games")
+  @rate_limited('delete')
+  @invalidates('games', 'characters')
+  def delete_games_bulk(jwt):
+    ids = bulk_ids()
+    games = delete_games(ids, cascade_arg())
+    deleted = {game['id'] for game in games}
 
     return jsonify({
       'success': True,
-      'game_id': game.id,
-      'title': game.title
+      'deleted': sorted(deleted),
+      'not_found': [id for id in ids if id not in deleted],
+      'characters_deleted': sum(len(game['character_ids']) for game in games)
     })
 
   @app.route("/characters/create", methods=["POST"])
   @requires_auth("post:characters")
+  @rate_limited('write')
+  @idempotent
+  @invalidates('characters', 'games')
   def post_character(jwt):
     body = request.get_json()
     try:
@@ -94,12 +454,9 @@ def create_app(test_config=None):
       intelligence = body.get('intelligence')
       good = body.get('good')
       new_game_id = body.get('game_id')
-      print("1")
 
       character = Character(name=name, fighting=fighting, intelligence=intelligence, good=good, game_id=new_game_id)
-      print("2")
       character.insert()
-      print("3")
       return jsonify({
         'success': True,
         'character_id': character.id,
@@ -108,42 +465,191 @@ def create_app(test_config=None):
     except:
       abort(400)
 
+  @app.route("/characters/bulk", methods=["POST"])
+  @requires_auth('post:characters')
+  @rate_limited('write')
+  @idempotent
+  @invalidates('characters', 'games')
+  def post_characters_bulk(jwt):
+    rows, errors = validate_bulk(Character, bulk_items())
+
+    game_ids = {row['game_id'] for index, row in rows}
+    if game_ids:
+      found = {id for (id,) in db.session.query(Game.id).filter(Game.id.in_(game_ids))}
+      for index, row in rows:
+        if row['game_id'] not in found:
+          errors.append({'index': index, 'error': 'game %d does not exist' % row['game_id']})
+
+    return bulk_response(Character, rows, errors)
+
   @app.route("/characters/<int:character_id>", methods=['DELETE'])
   @requires_auth('delete:characters')
+  @rate_limited('delete')
+  @invalidates('characters', 'games')
   def delete_character(jwt, character_id):
-    character =  Character.query.filter_by(id=character_id).first()
-
-    if character is None:
+    if not delete_characters([character_id]):
       abort(404)
-    character.delete()
 
     return jsonify({
       'success': True,
-      'character_id': character.id
+      'character_id': character_id
+    })
+
+  @app.route("/characters", methods=['DELETE'])
+  @requires_auth('delete:characters')
+  @rate_limited('delete')
+  @invalidates('characters', 'games')
+  def delete_characters_bulk(jwt):
+    ids = bulk_ids()
+    deleted = {character['id'] for character in delete_characters(ids)}
+
+    return jsonify({
+      'success': True,
+      'deleted': sorted(deleted),
+      'not_found': [id for id in ids if id not in deleted]
     })
 
   @app.route("/games/<int:game_id>", methods=['PATCH'])
   @requires_auth('patch:games')
+  @rate_limited('write')
+  @invalidates('games')
   def patch_game(jwt, game_id):
     body = request.get_json()
+    version = if_match_version()
+
+    values = {'rating': body.get("new_rating"), 'completed': body.get("completed")}
+
+    queue = get_queue()
+    if queue is not None and version is None:
+      # write-behind mode: the update is merged into the queue and written
+      # with the next batch, so it is checked here rather than by Postgres
+      if not (values['rating'] is None or is_int(values['rating'])) or not isinstance(values['completed'], bool):
+        abort(400)
+      if queue.add(game_id, values):
+        return jsonify({
+          "success": True,
+          "game_id": game_id,
+          "queued": True
+        }), 202
+
+    result = update_if_version(Game, game_id, version, values, ('title',) + GAME_FIELDS)
+
+    if result is None:
+      db.session.rollback()
+      if Game.query.get(game_id) is None:
+        abort(404)
+      abort(412)
+
+    previous, game, version = result
+    track_rows(Game, [previous], -1)
+    track_rows(Game, [game])
+    track_upserts(Game, [dict(game, id=game_id, version=version)])
+    db.session.commit()
 
-    new_rating= body.get("new_rating")
-    completed = body.get("completed")
+    return jsonify({
+      "success": True,
+      "title": game['title'],
+      "version": version
+    })
 
-    game = Game.query.filter(Game.id==game_id).one_or_none()
+  @app.route("/stats", methods=['GET'])
+  @requires_auth('get:games')
+  @rate_limited('list')
+  def get_stats(jwt):
+    overall = counters('all').get('', Counter())
+    genres = counters('genre')
 
-    if game is None:
+    return json_response({
+      "success": True,
+      "stats": dict(game_summary(overall), **character_summary(overall)),
+      "genres": {
+        genre: dict(game_summary(c), **character_summary(c)) for genre, c in sorted(genres.items()) if c['games']
+      }
+    })
+
+  @app.route("/stats/games/<int:game_id>", methods=['GET'])
+  @requires_auth('get:characters')
+  @rate_limited('list')
+  def get_game_stats(jwt, game_id):
+    if Game.query.get(game_id) is None:
       abort(404)
 
-    game.rating = new_rating
-    game.completed = completed
-    game.update()
+    c = counters('game', str(game_id)).get(str(game_id), Counter())
+
+    return json_response({
+      "success": True,
+      "game_id": game_id,
+      "stats": character_summary(c)
+    })
+
+  @app.cli.command('rebuild-stats')
+  def rebuild_stats():
+    rebuild()
+
+  @app.route("/changes", methods=['GET'])
+  @requires_auth('get:games')
+  @rate_limited('list')
+  def get_changes(jwt):
+    since, limit = changes_args()
+    wait = int_arg('wait') or 0
+    if wait < 0 or wait > MAX_CHANGES_WAIT:
+      abort(400)
+
+    if wait:
+      changes, more = wait_for_changes(since, limit, wait, visible_entities(jwt))
+    else:
+      changes, more = changes_since(since, limit, visible_entities(jwt))
 
+    return json_response({
+      "success": True,
+      "changes": [change.full() for change in changes],
+      "next_since": changes[-1].seq if changes else since,
+      "has_more": more
+    })
+
+  @app.route("/changes/stream", methods=['GET'])
+  @requires_auth('get:games')
+  @rate_limited('list')
+  def stream_changes(jwt):
+    since, limit = changes_args()
+    entities = visible_entities(jwt)
+
+    def events(since):
+      deadline = time.monotonic() + CHANGES_STREAM_SECONDS
+      while time.monotonic() < deadline:
+        changes, more = wait_for_changes(since, limit, CHANGES_HEARTBEAT_SECONDS, entities)
+        db.session.rollback()
+        if not changes:
+          yield b': keepalive\n\n'
+          continue
+        for change in changes:
+          yield b'id: %d\ndata: %s\n\n' % (change.seq, dumps(change.full()))
+        since = changes[-1].seq
+
+    return Response(stream_with_context(events(since)), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+  @app.cli.command('prune-changes')
+  @click.option('--keep', default=1000000, help='number of most recent changes to keep')
+  def prune_change_log(keep):
+    prune_changes(keep)
+
+  @app.cli.command('prune-idempotency-keys')
+  def prune_expired_idempotency_keys():
+    prune_idempotency_keys(app.config['IDEMPOTENCY_TTL'])
+
+  @app.route("/metrics", methods=['GET'])
+  def get_metrics():
+    queue = get_queue()
+    return Response(render_metrics(pool_stats(), queue.stats() if queue is not None else None), mimetype='text/plain; version=0.0.4')
+
+  @app.route("/health/pool", methods=['GET'])
+  def get_pool_stats():
     return jsonify({
       "success": True,
-      "title": game.title
+      "pools": pool_stats()
     })
-  
+
   @app.errorhandler(404)
   def not_found(error):
     return jsonify({
@@ -168,6 +674,46 @@ def create_app(test_config=None):
       'message': 'internal server error'
     }), 500
 
+  @app.errorhandler(409)
+  def conflict(error):
+    return jsonify({
+      "success": False,
+      "error": 409,
+      "message": 'conflict'
+    }), 409
+
+  @app.errorhandler(410)
+  def gone(error):
+    return jsonify({
+      "success": False,
+      "error": 410,
+      "message": 'gone'
+    }), 410
+
+  @app.errorhandler(412)
+  def precondition_failed(error):
+    return jsonify({
+      "success": False,
+      "error": 412,
+      "message": 'precondition failed'
+    }), 412
+
+  @app.errorhandler(422)
+  def unprocessable(error):
+    return jsonify({
+      "success": False,
+      "error": 422,
+      "message": 'unprocessable'
+    }), 422
+
+  @app.errorhandler(429)
+  def too_many_requests(error):
+    return jsonify({
+      "success": False,
+      "error": 429,
+      "message": 'too many requests'
+    }), 429
+
   @app.errorhandler(400)
   def bad_request(error):
     return jsonify({
@@ -185,15 +731,6 @@ def create_app(test_config=None):
 
   return app
 
-app = create_app()
-# db.create_all()
-
 
 if __name__ == '__main__':
-    APP.run(host='0.0.0.0', port=8080, debug=True)
-    
-
-# Test comment line
-# 
-
-
+  create_app().run(host='0.0.0.0', port=8080, debug=True)
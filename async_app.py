@@ -0,0 +1,26 @@
+'''
+Cooperative serving mode. The app is the one create_app() builds, so the
+routes, JSON bodies, error handlers and permission checks are the same as
+in the default mode; it just runs on gevent with psycopg2 made cooperative
+by psycogreen, so a worker keeps many requests in flight while they wait
+on Postgres or on Auth0 instead of one per thread.
+
+    gunicorn -k gevent --worker-connections 200 async_app:app
+
+Needs the gevent and psycogreen packages, see requirements-optional.txt.
+'''
+from gevent import monkey
+monkey.patch_all()
+
+from psycogreen.gevent import patch_psycopg
+patch_psycopg()
+
+import os
+
+from app import create_app
+
+# a request only holds a connection while a query runs, so a pool well below
+# --worker-connections keeps up; DB_POOL_SIZE still wins when it is set
+ASYNC_DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 20))
+
+app = create_app({'DB_POOL_SIZE': ASYNC_DB_POOL_SIZE})
@@ -0,0 +1,303 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from flask import request
+from functools import wraps
+from jose import jwt
+from urllib.request import urlopen
+
+from metrics import add_time
+
+
+AUTH0_DOMAIN = os.environ.get('AUTH0_DOMAIN', 'fsnd-nicks.eu.auth0.com')
+ALGORITHMS = ['RS256']
+API_AUDIENCE = os.environ.get('API_AUDIENCE', 'games-library')
+
+# a local JWKS document (or PEM public key) to verify against instead of
+# fetching https://AUTH0_DOMAIN/.well-known/jwks.json, e.g. for offline tests
+JWKS_FILE = os.environ.get('AUTH0_JWKS_FILE')
+JWKS_TTL = 600
+JWKS_MIN_REFRESH_INTERVAL = 30
+TOKEN_CACHE_SIZE = 10000
+
+
+## AuthError Exception
+'''
+AuthError Exception
+A standardized way to communicate auth failure modes
+'''
+class AuthError(Exception):
+    def __init__(self, error, status_code):
+        self.error = error
+        self.status_code = status_code
+
+
+class JWKSCache:
+    '''
+    Keeps the signing keys in a kid -> key table. Once the keys are older
+    than ttl they are refreshed in a background thread while the old ones
+    keep serving; an unknown kid forces a (rate limited) blocking refresh.
+    '''
+
+    def __init__(self, url=None, path=None, ttl=JWKS_TTL, min_refresh_interval=JWKS_MIN_REFRESH_INTERVAL):
+        self.url = url
+        self.path = path
+        self.ttl = ttl
+        self.min_refresh_interval = min_refresh_interval
+        self.keys = {}
+        self.loaded_at = None
+        self.refreshing = False
+        self.lock = threading.Lock()
+
+    def fetch(self):
+        if self.path:
+            with open(self.path) as f:
+                content = f.read()
+        else:
+            content = urlopen(self.url, timeout=5).read().decode()
+
+        if not content.lstrip().startswith('{'):
+            # a bare PEM public key, used for every kid
+            return {None: content}
+        return {key['kid']: key for key in json.loads(content)['keys']}
+
+    def refresh(self):
+        try:
+            keys = self.fetch()
+        finally:
+            with self.lock:
+                self.refreshing = False
+        with self.lock:
+            self.keys = keys
+            self.loaded_at = time.monotonic()
+
+    def refresh_in_background(self):
+        with self.lock:
+            if self.refreshing:
+                return
+            self.refreshing = True
+        threading.Thread(target=self.refresh, daemon=True).start()
+
+    def get(self, kid):
+        if self.loaded_at is None:
+            self.refresh()
+        elif time.monotonic() - self.loaded_at > self.ttl:
+            self.refresh_in_background()
+
+        key = self.keys.get(kid, self.keys.get(None))
+        if key is None and time.monotonic() - self.loaded_at > self.min_refresh_interval:
+            # the signing keys may have been rotated since the last fetch
+            self.refresh()
+            key = self.keys.get(kid, self.keys.get(None))
+        return key
+
+
+class TokenCache:
+    '''
+    Bounded LRU of already verified tokens, keyed by the token's sha256.
+    Entries are dropped as soon as the token's exp has passed.
+    '''
+
+    def __init__(self, max_size=TOKEN_CACHE_SIZE):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(token):
+        return hashlib.sha256(token.encode()).hexdigest()
+
+    def get(self, token):
+        key = self.key(token)
+        with self.lock:
+            payload = self.entries.get(key)
+            if payload is None:
+                return None
+            if payload['exp'] <= time.time():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return payload
+
+    def set(self, token, payload):
+        if 'exp' not in payload:
+            return
+        with self.lock:
+            self.entries[self.key(token)] = payload
+            self.entries.move_to_end(self.key(token))
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+jwks_cache = JWKSCache(url='https://%s/.well-known/jwks.json' % AUTH0_DOMAIN, path=JWKS_FILE)
+token_cache = TokenCache()
+
+
+## Auth Header
+'''
+get_token_auth_header() method
+    it attempts to get the header from the request
+    it raises an AuthError if no header is present
+    it attempts to split bearer and the token
+    it raises an AuthError if the header is malformed
+    return the token part of the header
+'''
+def get_token_auth_header():
+    auth = request.headers.get('Authorization', None)
+    if not auth:
+        raise AuthError({
+            'code': 'authorization_header_missing',
+            'description': 'Authorization header is expected.'
+        }, 401)
+
+    parts = auth.split()
+    if parts[0].lower() != 'bearer':
+        raise AuthError({
+            'code': 'invalid_header',
+            'description': 'Authorization header must start with "Bearer".'
+        }, 401)
+
+    elif len(parts) == 1:
+        raise AuthError({
+            'code': 'invalid_header',
+            'description': 'Token not found.'
+        }, 401)
+
+    elif len(parts) > 2:
+        raise AuthError({
+            'code': 'invalid_header',
+            'description': 'Authorization header must be bearer token.'
+        }, 401)
+
+    token = parts[1]
+    return token
+
+
+'''
+check_permissions(permission, payload) method
+    @INPUTS
+        permission: string permission (i.e. 'post:drink')
+        payload: decoded jwt payload
+
+    it raises an AuthError if permissions are not included in the payload
+    it raises an AuthError if the requested permission string is not in the payload permissions array
+    return true otherwise
+'''
+def check_permissions(permission, payload):
+    if 'permissions' not in payload:
+        raise AuthError({
+            'code': 'invalid_claims',
+            'description': 'Permissions not included in JWT.'
+        }, 400)
+
+    if permission not in payload['permissions']:
+        raise AuthError({
+            'code': 'unauthorized',
+            'description': 'Permission not found.'
+        }, 403)
+    return True
+
+
+'''
+verify_decode_jwt(token) method
+    @INPUTS
+        token: a json web token (string)
+
+    it is an Auth0 token with key id (kid)
+    it verifies the token using the cached Auth0 /.well-known/jwks.json keys
+    it decodes the payload from the token
+    it validates the claims
+    return the decoded payload
+
+    tokens that already passed verification are served from token_cache
+    until they expire, so the RSA check runs once per token
+'''
+def verify_decode_jwt(token):
+    payload = token_cache.get(token)
+    if payload is not None:
+        return payload
+
+    try:
+        unverified_header = jwt.get_unverified_header(token)
+    except jwt.JWTError:
+        raise AuthError({
+            'code': 'invalid_header',
+            'description': 'Unable to parse authentication token.'
+        }, 401)
+
+    if 'kid' not in unverified_header:
+        raise AuthError({
+            'code': 'invalid_header',
+            'description': 'Authorization malformed.'
+        }, 401)
+
+    key = jwks_cache.get(unverified_header['kid'])
+    if key is None:
+        raise AuthError({
+            'code': 'invalid_header',
+            'description': 'Unable to find the appropriate key.'
+        }, 400)
+
+    try:
+        payload = jwt.decode(
+            token,
+            key,
+            algorithms=ALGORITHMS,
+            audience=API_AUDIENCE,
+            issuer='https://' + AUTH0_DOMAIN + '/'
+        )
+
+    except jwt.ExpiredSignatureError:
+        raise AuthError({
+            'code': 'token_expired',
+            'description': 'Token expired.'
+        }, 401)
+
+    except jwt.JWTClaimsError:
+        raise AuthError({
+            'code': 'invalid_claims',
+            'description': 'Incorrect claims. Please, check the audience and issuer.'
+        }, 401)
+
+    except Exception:
+        raise AuthError({
+            'code': 'invalid_header',
+            'description': 'Unable to parse authentication token.'
+        }, 400)
+
+    token_cache.set(token, payload)
+    return payload
+
+
+'''
+@requires_auth(permission) decorator method
+    @INPUTS
+        permission: string permission (i.e. 'post:drink')
+
+    it uses the get_token_auth_header method to get the token
+    it uses the verify_decode_jwt method to decode the jwt
+    it uses the check_permissions method validate claims and check the requested permission
+    return the decorator which passes the decoded payload to the decorated method
+'''
+def requires_auth(permission=''):
+    def requires_auth_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                token = get_token_auth_header()
+                payload = verify_decode_jwt(token)
+                check_permissions(permission, payload)
+            finally:
+                add_time('auth', time.perf_counter() - start)
+            return f(payload, *args, **kwargs)
+
+        return wrapper
+    return requires_auth_decorator
@@ -0,0 +1,56 @@
+# Measures bulk character import throughput against a real database.
+#
+#   DATABASE_URL=postgresql://localhost:5432/game_test python benchmarks/bench_bulk_insert.py
+#
+# Exits non-zero when the rate is below --target rows/second.
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from app import create_app, validate_bulk
+from models import bulk_insert, db, Character, Game
+
+BULK_ROWS_PER_SECOND_TARGET = 20000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=50000)
+    parser.add_argument('--target', type=float, default=BULK_ROWS_PER_SECOND_TARGET)
+    args = parser.parse_args()
+
+    app = create_app()
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.environ['DATABASE_URL']
+
+    with app.app_context():
+        db.create_all()
+        game = Game(title='bulk benchmark', genres=['Benchmark'], rating=1, completed=False)
+        game.insert()
+
+        items = [{
+            'name': 'bench character %d' % i,
+            'fighting': i % 10,
+            'intelligence': i % 7,
+            'good': i % 2 == 0,
+            'game_id': game.id
+        } for i in range(args.rows)]
+
+        start = time.perf_counter()
+        rows, errors = validate_bulk(Character, items)
+        ids = bulk_insert(Character, [row for index, row in rows])
+        elapsed = time.perf_counter() - start
+
+        Character.query.filter(Character.game_id == game.id).delete(synchronize_session=False)
+        game.delete()
+
+    rate = len(ids) / elapsed
+    print('inserted %d rows in %.3fs: %.0f rows/s (target %.0f)' % (len(ids), elapsed, rate, args.target))
+    if errors or rate < args.target:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
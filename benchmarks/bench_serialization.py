@@ -0,0 +1,69 @@
+# Compares the ORM + full() + jsonify list path with the column tuple +
+# serializers.dumps path on an in-memory sqlite table of characters.
+#
+#   python benchmarks/bench_serialization.py --rows 100000
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+
+from flask import jsonify
+
+from app import create_app
+from models import db, Character
+from serializers import dumps, orjson, row_dicts, select_fields
+
+
+def orm_path():
+    characters = Character.query.order_by(Character.id).all()
+    return jsonify({"success": True, "characters": [character.full() for character in characters]}).get_data()
+
+
+def tuple_path():
+    columns = select_fields(Character)
+    rows = Character.query.with_entities(*columns).order_by(Character.id).all()
+    return dumps({"success": True, "characters": list(row_dicts(columns, rows))})
+
+
+def best_of(f, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        f()
+        times.append(time.perf_counter() - start)
+        db.session.remove()
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=50000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    app = create_app()
+    with app.app_context():
+        Character.__table__.create(db.engine)
+        db.session.execute(Character.__table__.insert(), [{
+            'name': 'character %d' % i,
+            'fighting': i % 10,
+            'intelligence': i % 7,
+            'good': i % 2 == 0,
+            'game_id': 1
+        } for i in range(args.rows)])
+        db.session.commit()
+
+        with app.test_request_context():
+            orm = best_of(orm_path, args.repeat)
+            tuples = best_of(tuple_path, args.repeat)
+
+    print('rows: %d, encoder: %s' % (args.rows, 'orjson' if orjson else 'json'))
+    print('orm + full() + jsonify: %.1f ms' % (orm * 1000))
+    print('tuples + dumps:         %.1f ms (%.1fx)' % (tuples * 1000, orm / tuples))
+
+
+if __name__ == '__main__':
+    main()
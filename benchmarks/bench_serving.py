@@ -0,0 +1,129 @@
+# Compares the two serving modes over real HTTP: gunicorn sync workers with
+# threads (wsgi:app) against gevent workers (async_app:app). Both servers get
+# the same seeded Postgres database, the same worker count and the same load.
+#
+#   python benchmarks/bench_serving.py --database postgresql://localhost:5432/game_bench
+#
+# Needs gunicorn, gevent and psycogreen. The database is dropped and re-seeded.
+import argparse
+import os
+import random
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+from app import create_app
+from harness import LocalSigner, percentile, seed
+from models import db
+
+MODES = {
+    'sync': lambda args: ['-w', str(args.workers), '--threads', str(args.threads), 'wsgi:app'],
+    'async': lambda args: ['-w', str(args.workers), '-k', 'gevent',
+                           '--worker-connections', str(args.concurrency * 2), 'async_app:app'],
+}
+
+
+def routes(game_ids):
+    return [
+        ('GET /games', 'GET', lambda: '/games?limit=50&cursor=%d' % random.choice(game_ids), None),
+        ('GET /games/<id>', 'GET', lambda: '/games/%d?include=characters' % random.choice(game_ids), None),
+        ('GET /characters', 'GET', lambda: '/characters?game_id=%d' % random.choice(game_ids), None),
+        ('GET /stats', 'GET', lambda: '/stats', None),
+        ('PATCH /games/<id>', 'PATCH', lambda: '/games/%d' % random.choice(game_ids),
+         b'{"new_rating": 7, "completed": true}'),
+    ]
+
+
+def start_server(mode, args, env):
+    port = str(args.port)
+    server = subprocess.Popen(
+        ['gunicorn', '-b', '127.0.0.1:' + port] + MODES[mode](args), cwd=ROOT, env=env,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            urllib.request.urlopen('http://127.0.0.1:%s/health/pool' % port, timeout=1)
+            return server
+        except (urllib.error.URLError, ConnectionError):
+            time.sleep(0.2)
+    server.kill()
+    raise RuntimeError('%s server did not start' % mode)
+
+
+def run_route(base, token, route, requests, concurrency):
+    name, method, path, body = route
+
+    def one(_):
+        request = urllib.request.Request(base + path(), data=body, method=method, headers={
+            'Authorization': 'Bearer ' + token, 'Content-Type': 'application/json'})
+        start = time.perf_counter()
+        try:
+            urllib.request.urlopen(request, timeout=30).read()
+            ok = True
+        except urllib.error.HTTPError as error:
+            ok = error.code == 404
+        return time.perf_counter() - start, ok
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(one, range(requests)))
+    wall = time.perf_counter() - start
+
+    latencies = [elapsed for elapsed, ok in results]
+    return {
+        'throughput': requests / wall,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p95_ms': percentile(latencies, 0.95) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'errors': sum(1 for elapsed, ok in results if not ok)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--database', required=True, help='URL of a dedicated Postgres database, it is dropped and re-seeded')
+    parser.add_argument('--games', type=int, default=2000)
+    parser.add_argument('--characters', type=int, default=10000)
+    parser.add_argument('--requests', type=int, default=1000, help='requests per route')
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--threads', type=int, default=8, help='threads per sync worker')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--mode', action='append', choices=sorted(MODES), help='only run these modes')
+    args = parser.parse_args()
+
+    signer = LocalSigner()
+    app = create_app({'SQLALCHEMY_DATABASE_URI': args.database})
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        game_ids = seed(args.games, args.characters)
+
+    env = dict(os.environ, DATABASE_URL=args.database, AUTH0_JWKS_FILE=signer.key_file.name,
+               GUNICORN_THREADS=str(args.threads), CACHE_ENABLED='false', RATE_LIMIT_ENABLED='false')
+    token = signer.token()
+
+    print('%-6s %-20s %10s %9s %9s %9s %7s' % ('mode', 'route', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'errors'))
+    for mode in args.mode or sorted(MODES, reverse=True):
+        server = start_server(mode, args, env)
+        try:
+            for route in routes(game_ids):
+                result = run_route('http://127.0.0.1:%d' % args.port, token, route, args.requests, args.concurrency)
+                print('%-6s %-20s %10.1f %9.2f %9.2f %9.2f %7d' % (
+                    mode, route[0], result['throughput'], result['p50_ms'], result['p95_ms'], result['p99_ms'],
+                    result['errors']))
+        finally:
+            server.terminate()
+            server.wait()
+
+    signer.close()
+
+
+if __name__ == '__main__':
+    main()
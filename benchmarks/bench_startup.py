@@ -0,0 +1,97 @@
+# Measures how long a fresh process takes to get a ready app from each entry
+# point: the serving one (wsgi), the flask command's (manage, which also loads
+# the migration tooling) and optionally the gevent one (async_app). Each run is
+# a new interpreter, split into importing app.py and building the app in the
+# entry module, followed by a -X importtime breakdown by top-level package.
+#
+#   python benchmarks/bench_startup.py --runs 10
+#
+# Nothing connects to the database, DATABASE_URL defaults to in-memory sqlite.
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from collections import Counter
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+ENTRY_POINTS = ['wsgi', 'manage', 'async_app']
+
+# async_app has to patch before anything imports threading or psycopg2, so
+# for it the import app column includes the gevent patching
+PATCHES = {
+    'async_app': 'from gevent import monkey; monkey.patch_all()\n'
+                 'from psycogreen.gevent import patch_psycopg; patch_psycopg()\n'
+}
+
+TIMED_IMPORT = '''
+import json, time
+start = time.perf_counter()
+%s
+import app
+imported = time.perf_counter()
+import %s
+print(json.dumps({'import_app': imported - start, 'create_app': time.perf_counter() - imported}))
+'''
+
+
+def run(entry, env, importtime=False):
+    script = TIMED_IMPORT % (PATCHES.get(entry, ''), entry)
+    command = [sys.executable] + (['-X', 'importtime'] if importtime else []) + ['-c', script]
+    start = time.perf_counter()
+    result = subprocess.run(command, cwd=ROOT, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            universal_newlines=True)
+    wall = time.perf_counter() - start
+    if result.returncode != 0:
+        raise RuntimeError('importing %s failed:\n%s' % (entry, result.stderr))
+    timings = json.loads(result.stdout.strip().splitlines()[-1])
+    timings['process'] = wall
+    return timings, result.stderr
+
+
+def import_breakdown(stderr):
+    # microseconds of self time per top-level package, from -X importtime's
+    # "import time: self [us] | cumulative | name" lines
+    packages = Counter()
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, _, name = line[len('import time:'):].split('|')
+        packages[name.strip().split('.')[0]] += int(self_us)
+    return packages
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=5, help='fresh processes per entry point')
+    parser.add_argument('--entry', action='append', choices=ENTRY_POINTS,
+                        help='only time these entry points (default wsgi and manage)')
+    parser.add_argument('--top', type=int, default=15, help='packages to list in the import breakdown')
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    env.setdefault('DATABASE_URL', 'sqlite://')
+    entries = args.entry or ['wsgi', 'manage']
+
+    print('%-10s %14s %14s %12s' % ('entry', 'import app ms', 'create app ms', 'process ms'))
+    for entry in entries:
+        # one untimed run so every run reads compiled .pyc files
+        run(entry, env)
+        results = [run(entry, env)[0] for _ in range(args.runs)]
+        print('%-10s %14.1f %14.1f %12.1f' % (
+            entry, statistics.median(r['import_app'] for r in results) * 1000,
+            statistics.median(r['create_app'] for r in results) * 1000,
+            statistics.median(r['process'] for r in results) * 1000))
+
+    for entry in entries:
+        packages = import_breakdown(run(entry, env, importtime=True)[1])
+        print('\nimport time by package, %s (%.1f ms in total)' % (entry, sum(packages.values()) / 1000))
+        for name, self_us in packages.most_common(args.top):
+            print('  %-24s %8.1f ms' % (name, self_us / 1000))
+
+
+if __name__ == '__main__':
+    main()
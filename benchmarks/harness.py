@@ -0,0 +1,295 @@
+# Load-testing harness: builds the app with create_app(test_config) against a
+# local database, signs its own tokens with a throwaway RSA key (verified
+# offline through auth.auth's AUTH0_JWKS_FILE support), seeds games and
+# characters, then drives every endpoint from a thread pool.
+#
+#   python benchmarks/harness.py                                  # sqlite stand-in
+#   python benchmarks/harness.py --database postgresql://localhost:5432/game_bench
+#   python benchmarks/harness.py --save-baseline                  # record baseline.json
+#
+# For each route it reports throughput, p50/p95/p99 latency and SQL statements
+# per request. With a baseline present, a p95 more than --tolerance slower or
+# more statements per request than recorded fails the run.
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import rsa
+from jose import jwt
+from sqlalchemy import event
+
+from app import create_app
+from auth import auth
+from models import db, Character, Game
+import stats
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+GENRES = ['Action', 'Adventure', 'Horror', 'Platformer', 'Puzzle', 'RPG', 'Racing', 'Strategy']
+PERMISSIONS = [
+    'get:games', 'get:characters', 'post:games', 'post:characters',
+    'delete:games', 'delete:characters', 'patch:games'
+]
+
+
+class LocalSigner:
+    # stands in for Auth0: tokens are signed with a local key and
+    # requires_auth verifies them against its public half
+
+    def __init__(self):
+        public_key, self.private_key = rsa.newkeys(2048)
+        self.key_file = tempfile.NamedTemporaryFile(suffix='.pem', delete=False)
+        self.key_file.write(public_key.save_pkcs1())
+        self.key_file.close()
+        auth.jwks_cache = auth.JWKSCache(path=self.key_file.name)
+        auth.token_cache.clear()
+
+    def token(self, permissions=PERMISSIONS, expires_in=3600):
+        claims = {
+            'iss': 'https://' + auth.AUTH0_DOMAIN + '/',
+            'aud': auth.API_AUDIENCE,
+            'sub': 'benchmark',
+            'exp': int(time.time()) + expires_in,
+            'permissions': permissions
+        }
+        return jwt.encode(claims, self.private_key.save_pkcs1().decode(), algorithm='RS256', headers={'kid': 'benchmark'})
+
+    def close(self):
+        os.remove(self.key_file.name)
+
+
+class QueryCounter:
+    # SQL statements executed by the current thread, i.e. the current request
+
+    def __init__(self, engine):
+        self.local = threading.local()
+        event.listen(engine, 'before_cursor_execute', self.count)
+
+    def count(self, *args):
+        self.local.count = getattr(self.local, 'count', 0) + 1
+
+    def reset(self):
+        self.local.count = 0
+
+    def value(self):
+        return getattr(self.local, 'count', 0)
+
+
+def seed(games, characters, batch_size=5000):
+    rows = [{
+        'title': 'Game %d' % i,
+        'genres': random.sample(GENRES, random.randint(1, 3)),
+        'rating': random.randint(1, 10),
+        'completed': random.random() < 0.5
+    } for i in range(games)]
+    for start in range(0, games, batch_size):
+        db.session.execute(Game.__table__.insert(), rows[start:start + batch_size])
+
+    game_ids = [id for (id,) in db.session.query(Game.id)]
+    rows = [{
+        'name': 'Character %d' % i,
+        'fighting': random.randint(1, 10),
+        'intelligence': random.randint(1, 10),
+        'good': random.random() < 0.7,
+        'game_id': random.choice(game_ids)
+    } for i in range(characters)]
+    for start in range(0, characters, batch_size):
+        db.session.execute(Character.__table__.insert(), rows[start:start + batch_size])
+    db.session.commit()
+
+    stats.rebuild()
+    return game_ids
+
+
+def routes(game_ids, postgres):
+    # ids of rows created by the POST routes, deleted again by the DELETE ones
+    created = {'game': [], 'character': []}
+    lock = threading.Lock()
+
+    def any_game():
+        return random.choice(game_ids)
+
+    def create_character():
+        return {'name': 'Benchmark character', 'fighting': 5, 'intelligence': 5, 'good': True, 'game_id': any_game()}
+
+    def create_game():
+        return {'title': 'Benchmark game', 'genres': ['Action'], 'rating': 5, 'completed': False}
+
+    def take(kind, count):
+        # 0 when they have run out, which the deletes answer as not found
+        with lock:
+            ids = [created[kind].pop() for _ in range(min(count, len(created[kind])))]
+        return ids or [0]
+
+    def remember(kind):
+        def after(data):
+            ids = [data.get(kind + '_id')] + [result.get('id') for result in data.get('results', [])]
+            with lock:
+                created[kind].extend(id for id in ids if id)
+        return after
+
+    # name, method, path, body, after-response hook, needs postgres
+    table = [
+        ('GET /games', 'GET', lambda: '/games', None, None, False),
+        ('GET /games (cursor)', 'GET', lambda: '/games?limit=50&cursor=%d' % any_game(), None, None, False),
+        ('GET /games (filtered)', 'GET', lambda: '/games?completed=true&min_rating=5&max_rating=9', None, None, False),
+        ('GET /games (genre)', 'GET', lambda: '/games?genre=' + random.choice(GENRES), None, None, True),
+        ('GET /games (short fields)', 'GET', lambda: '/games?fields=short&limit=1000', None, None, False),
+        ('GET /games (include)', 'GET', lambda: '/games?include=characters&limit=20', None, None, False),
+        ('GET /games/<id>', 'GET', lambda: '/games/%d?include=characters' % any_game(), None, None, False),
+        ('GET /characters', 'GET', lambda: '/characters', None, None, False),
+        ('GET /characters (game)', 'GET', lambda: '/characters?game_id=%d' % any_game(), None, None, False),
+        ('GET /games/search', 'GET', lambda: '/games/search?q=Game %d' % random.randint(1, 99), None, None, False),
+        ('GET /characters/search', 'GET', lambda: '/characters/search?q=Character %d&mode=prefix' % random.randint(1, 99), None, None, False),
+        ('GET /stats', 'GET', lambda: '/stats', None, None, False),
+        ('GET /stats/games/<id>', 'GET', lambda: '/stats/games/%d' % any_game(), None, None, False),
+        ('GET /changes', 'GET', lambda: '/changes?limit=100', None, None, False),
+        ('GET /metrics', 'GET', lambda: '/metrics', None, None, False),
+        ('GET /health/pool', 'GET', lambda: '/health/pool', None, None, False),
+        ('POST /games/create', 'POST', lambda: '/games/create', create_game, remember('game'), False),
+        ('POST /games/bulk', 'POST', lambda: '/games/bulk', lambda: [create_game() for _ in range(100)], remember('game'), True),
+        ('POST /characters/create', 'POST', lambda: '/characters/create', create_character, remember('character'), False),
+        ('POST /characters/bulk', 'POST', lambda: '/characters/bulk', lambda: [create_character() for _ in range(100)], remember('character'), True),
+        ('PATCH /games/<id>', 'PATCH', lambda: '/games/%d' % any_game(), lambda: {'new_rating': random.randint(1, 10), 'completed': True}, None, False),
+        ('DELETE /games/<id>', 'DELETE', lambda: '/games/%d' % take('game', 1)[0], None, None, False),
+        ('DELETE /games', 'DELETE', lambda: '/games', lambda: {'ids': take('game', 20)}, None, False),
+        ('DELETE /characters/<id>', 'DELETE', lambda: '/characters/%d' % take('character', 1)[0], None, None, False),
+        ('DELETE /characters', 'DELETE', lambda: '/characters', lambda: {'ids': take('character', 20)}, None, False),
+    ]
+    return [route for route in table if postgres or not route[5]]
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def run_route(app, counter, headers, route, requests, concurrency):
+    name, method, path, body, after, postgres_only = route
+    client = app.test_client()
+
+    def one(_):
+        counter.reset()
+        start = time.perf_counter()
+        response = client.open(path(), method=method, json=body() if body else None, headers=headers)
+        elapsed = time.perf_counter() - start
+        if after is not None:
+            after(response.get_json() or {})
+        return elapsed, counter.value(), response.status_code
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(one, range(requests)))
+    wall = time.perf_counter() - start
+
+    latencies = [elapsed for elapsed, queries, status in results]
+    return {
+        'requests': requests,
+        'errors': sum(1 for elapsed, queries, status in results if status >= 400 and status != 404),
+        'throughput': requests / wall,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p95_ms': percentile(latencies, 0.95) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'queries_per_request': sum(queries for elapsed, queries, status in results) / requests
+    }
+
+
+def regressions(results, baseline, tolerance):
+    failures = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        expected = baseline[name]
+        if result['p95_ms'] > expected['p95_ms'] * (1 + tolerance):
+            failures.append('%s: p95 %.1fms, baseline %.1fms' % (name, result['p95_ms'], expected['p95_ms']))
+        if result['queries_per_request'] > expected['queries_per_request'] + 0.5:
+            failures.append('%s: %.1f queries per request, baseline %.1f' % (
+                name, result['queries_per_request'], expected['queries_per_request']))
+        if result['errors']:
+            failures.append('%s: %d failed requests' % (name, result['errors']))
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--database', default=None,
+                        help='URL of a dedicated database, it is dropped and re-seeded (a temporary sqlite file by default)')
+    parser.add_argument('--games', type=int, default=2000)
+    parser.add_argument('--characters', type=int, default=10000)
+    parser.add_argument('--requests', type=int, default=200, help='requests per route')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--cache', action='store_true', help='turn the response cache on')
+    parser.add_argument('--route', action='append', help='only run routes whose name contains this')
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    args = parser.parse_args()
+
+    database = args.database
+    sqlite_file = None
+    if database is None:
+        sqlite_file = tempfile.NamedTemporaryFile(suffix='.db', delete=False).name
+        database = 'sqlite:///' + sqlite_file
+    postgres = database.startswith('postgres')
+
+    signer = LocalSigner()
+    app = create_app({'SQLALCHEMY_DATABASE_URI': database, 'CACHE_ENABLED': args.cache,
+                      'RATE_LIMIT_ENABLED': False})
+
+    with app.app_context():
+        engine = db.engine
+        if not postgres:
+            # stand-in for pg_trgm's similarity() used to rank search results
+            @event.listens_for(engine, 'connect')
+            def sqlite_functions(connection, record):
+                import difflib
+                connection.create_function(
+                    'similarity', 2, lambda a, b: difflib.SequenceMatcher(None, a or '', b or '').ratio())
+            engine.dispose()
+
+        db.drop_all()
+        db.create_all()
+        game_ids = seed(args.games, args.characters)
+
+    counter = QueryCounter(engine)
+    headers = {'Authorization': 'Bearer ' + signer.token()}
+
+    results = {}
+    print('%-28s %10s %9s %9s %9s %8s %7s' % ('route', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'queries', 'errors'))
+    for route in routes(game_ids, postgres):
+        if args.route and not any(part in route[0] for part in args.route):
+            continue
+        result = run_route(app, counter, headers, route, args.requests, args.concurrency)
+        results[route[0]] = result
+        print('%-28s %10.1f %9.2f %9.2f %9.2f %8.1f %7d' % (
+            route[0], result['throughput'], result['p50_ms'], result['p95_ms'], result['p99_ms'],
+            result['queries_per_request'], result['errors']))
+
+    signer.close()
+    if sqlite_file:
+        os.remove(sqlite_file)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print('baseline written to %s' % args.baseline)
+        return
+
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            failures = regressions(results, json.load(f), args.tolerance)
+        for failure in failures:
+            print('REGRESSION ' + failure)
+        if failures:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,212 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from flask import Response, current_app, request
+
+DEFAULT_CACHE_MAX_BYTES = 64 * 1024 * 1024
+DEFAULT_CACHE_TTL = 60
+
+
+class CacheEntry:
+    __slots__ = ('body', 'etag', 'mimetype', 'expires')
+
+    def __init__(self, body, etag, mimetype, expires=None):
+        self.body = body
+        self.etag = etag
+        self.mimetype = mimetype
+        self.expires = expires
+
+    def size(self):
+        return len(self.body) + len(self.etag) + len(self.mimetype)
+
+
+class LRUCache:
+    # in-process cache, bounded by the total size of the cached bodies; each
+    # namespace has a generation, bumped by invalidate, so a body read before
+    # a write committed is not stored after the write invalidated it
+
+    def __init__(self, max_bytes=DEFAULT_CACHE_MAX_BYTES, ttl=DEFAULT_CACHE_TTL):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.bytes = 0
+        self.entries = OrderedDict()
+        self.generations = {}
+        self.lock = threading.Lock()
+
+    def generation(self, namespace):
+        with self.lock:
+            return self.generations.get(namespace, 0)
+
+    def get(self, namespace, key):
+        with self.lock:
+            entry = self.entries.get((namespace, key))
+            if entry is None:
+                return None
+            if entry.expires < time.monotonic():
+                self._remove((namespace, key))
+                return None
+            self.entries.move_to_end((namespace, key))
+            return entry
+
+    def set(self, namespace, key, entry, generation=None):
+        size = entry.size()
+        if size > self.max_bytes:
+            return
+        entry.expires = time.monotonic() + self.ttl
+        with self.lock:
+            if generation is not None and generation != self.generations.get(namespace, 0):
+                return
+            self._remove((namespace, key))
+            self.entries[(namespace, key)] = entry
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+
+    def invalidate(self, namespace):
+        with self.lock:
+            self.generations[namespace] = self.generations.get(namespace, 0) + 1
+            for cache_key in [k for k in self.entries if k[0] == namespace]:
+                self._remove(cache_key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def _remove(self, cache_key):
+        entry = self.entries.pop(cache_key, None)
+        if entry is not None:
+            self.bytes -= entry.size()
+
+
+class RedisCache:
+    # shared cache for several workers/nodes; each namespace has a generation
+    # counter in redis, so invalidating is one INCR and old entries expire
+
+    def __init__(self, url, ttl=DEFAULT_CACHE_TTL, prefix='game-service:cache'):
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def generation(self, namespace):
+        return (self.client.get('%s:%s:generation' % (self.prefix, namespace)) or b'0').decode()
+
+    def _key(self, namespace, key, generation=None):
+        if generation is None:
+            generation = self.generation(namespace)
+        return '%s:%s:%s:%s' % (self.prefix, namespace, generation, key)
+
+    def get(self, namespace, key):
+        body, etag, mimetype = self.client.hmget(self._key(namespace, key), 'body', 'etag', 'mimetype')
+        if body is None:
+            return None
+        return CacheEntry(body, etag.decode(), mimetype.decode())
+
+    def set(self, namespace, key, entry, generation=None):
+        # stored under the generation read before the body was built, so a
+        # body from before an invalidation lands under a key no one reads
+        cache_key = self._key(namespace, key, generation)
+        pipe = self.client.pipeline()
+        pipe.hset(cache_key, mapping={'body': entry.body, 'etag': entry.etag, 'mimetype': entry.mimetype})
+        pipe.expire(cache_key, self.ttl)
+        pipe.execute()
+
+    def invalidate(self, namespace):
+        self.client.incr('%s:%s:generation' % (self.prefix, namespace))
+
+    def clear(self):
+        for cache_key in self.client.scan_iter('%s:*' % self.prefix):
+            self.client.delete(cache_key)
+
+
+def setup_cache(app):
+    app.config.setdefault('CACHE_REDIS_URL', os.environ.get('CACHE_REDIS_URL'))
+    # the in-process LRU is only invalidated by writes in its own process, so
+    # it is off by default unless the cache is shared
+    default_enabled = 'true' if app.config['CACHE_REDIS_URL'] else 'false'
+    app.config.setdefault('CACHE_ENABLED', os.environ.get('CACHE_ENABLED', default_enabled).lower() == 'true')
+    app.config.setdefault('CACHE_MAX_BYTES', DEFAULT_CACHE_MAX_BYTES)
+    app.config.setdefault('CACHE_TTL', DEFAULT_CACHE_TTL)
+
+    if app.config['CACHE_REDIS_URL']:
+        cache = RedisCache(app.config['CACHE_REDIS_URL'], ttl=app.config['CACHE_TTL'])
+    else:
+        cache = LRUCache(max_bytes=app.config['CACHE_MAX_BYTES'], ttl=app.config['CACHE_TTL'])
+
+    app.extensions['response_cache'] = cache
+    return cache
+
+
+def get_cache():
+    if not current_app.config.get('CACHE_ENABLED'):
+        return None
+    return current_app.extensions.get('response_cache')
+
+
+def not_modified(etag):
+    return etag in request.if_none_match
+
+
+def cached_response(entry):
+    if not_modified(entry.etag):
+        response = Response(status=304)
+    else:
+        response = Response(entry.body, mimetype=entry.mimetype)
+    response.set_etag(entry.etag)
+    return response
+
+
+def cached(namespace, skip=None):
+    # caches the body of successful responses under the full request path;
+    # the ETag is a hash of the body (or the one the handler set), so a hit
+    # with a matching If-None-Match is answered with a 304 without touching
+    # the database or the encoder
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            cache = get_cache()
+            if cache is None or (skip is not None and skip()):
+                return f(*args, **kwargs)
+
+            key = request.full_path
+            entry = cache.get(namespace, key)
+            if entry is not None:
+                return cached_response(entry)
+
+            # read before the handler queries, so a write that commits and
+            # invalidates meanwhile keeps this body out of the cache
+            generation = cache.generation(namespace)
+
+            response = current_app.make_response(f(*args, **kwargs))
+            if response.status_code != 200 or response.is_streamed:
+                return response
+
+            # a hash of the body, unless the handler set its own ETag
+            body = response.get_data()
+            etag = response.get_etag()[0] or hashlib.md5(body).hexdigest()
+            entry = CacheEntry(body, etag, response.mimetype)
+            cache.set(namespace, key, entry, generation)
+            return cached_response(entry)
+        return wrapper
+    return decorator
+
+
+def invalidates(*namespaces):
+    # drops the given namespaces once the wrapped write handler has committed
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            response = current_app.make_response(f(*args, **kwargs))
+            cache = get_cache()
+            if cache is not None and response.status_code < 400:
+                for namespace in namespaces:
+                    cache.invalidate(namespace)
+            return response
+        return wrapper
+    return decorator
@@ -0,0 +1,131 @@
+import threading
+import time
+
+from sqlalchemy import event, func, inspect, select
+
+from models import db, Change, Character, Game, RoutingSession, Stat
+
+ENTITIES = {Game: 'game', Character: 'character'}
+ENTITY_PERMISSIONS = {'game': 'get:games', 'character': 'get:characters'}
+PRUNED_THROUGH = ('changes', '', 'pruned_through')
+POLL_INTERVAL = 1.0
+MAX_CHANGES_WAIT = 30
+CHANGES_HEARTBEAT_SECONDS = 15
+# SSE clients reconnect with Last-Event-ID after this, freeing the worker
+CHANGES_STREAM_SECONDS = 300
+# pg_advisory_xact_lock key serializing the change log's inserts
+CHANGE_LOG_LOCK = 0x6368616e
+
+# woken after a commit in this process wrote changes; commits made by other
+# processes are picked up by the next poll
+new_changes = threading.Condition()
+
+
+'''
+Like the stats counters, changes are collected per session while rows are
+flushed (or passed in by the writes that bypass the ORM) and inserted right
+before the transaction commits. On Postgres the inserts take a transaction
+level advisory lock, so seqs are handed out in commit order: once a reader
+has seen seq n it has seen every change below n.
+'''
+def pending(session):
+    return session.info.setdefault('changes', [])
+
+
+def track_upserts(model, rows):
+    # rows in the model's full() shape
+    pending(db.session()).extend((ENTITIES[model], row['id'], 'upsert', row) for row in rows)
+
+
+def track_deletes(model, ids):
+    pending(db.session()).extend((ENTITIES[model], id, 'delete', None) for id in ids)
+
+
+@event.listens_for(RoutingSession, 'after_flush')
+def collect(session, flush_context):
+    changes = pending(session)
+    for obj in session.new:
+        if type(obj) in ENTITIES:
+            changes.append((ENTITIES[type(obj)], obj.id, 'upsert', obj.full()))
+    for obj in session.dirty:
+        if type(obj) in ENTITIES and session.is_modified(obj):
+            changes.append((ENTITIES[type(obj)], obj.id, 'upsert', obj.full()))
+    for obj in session.deleted:
+        if type(obj) in ENTITIES:
+            changes.append((ENTITIES[type(obj)], obj.id, 'delete', None))
+
+
+@event.listens_for(RoutingSession, 'before_commit')
+def write(session):
+    session.flush()
+    changes = session.info.pop('changes', None)
+    if not changes:
+        return
+
+    connection = session.connection(mapper=inspect(Change))
+    if connection.dialect.name == 'postgresql':
+        connection.execute(select([func.pg_advisory_xact_lock(CHANGE_LOG_LOCK)]))
+    connection.execute(Change.__table__.insert(), [
+        {'entity': entity, 'entity_id': id, 'op': op, 'data': data} for entity, id, op, data in changes
+    ])
+    session.info['changes_written'] = True
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+def notify(session):
+    if session.info.pop('changes_written', False):
+        with new_changes:
+            new_changes.notify_all()
+
+
+@event.listens_for(RoutingSession, 'after_rollback')
+def discard(session):
+    session.info.pop('changes', None)
+    session.info.pop('changes_written', None)
+
+
+def pruned_through():
+    stat = Stat.query.get(PRUNED_THROUGH)
+    return stat.value if stat is not None else 0
+
+
+def visible_entities(payload):
+    # character changes carry whole characters, so they need get:characters
+    permissions = payload.get('permissions', [])
+    return [entity for entity, permission in ENTITY_PERMISSIONS.items() if permission in permissions]
+
+
+def changes_since(seq, limit, entities):
+    rows = Change.query.filter(Change.seq > seq, Change.entity.in_(entities)).order_by(
+        Change.seq).limit(limit + 1).all()
+    return rows[:limit], len(rows) > limit
+
+
+def wait_for_changes(seq, limit, timeout, entities):
+    # long poll: the first page after seq, waiting up to timeout seconds for one
+    deadline = time.monotonic() + timeout
+    while True:
+        rows, more = changes_since(seq, limit, entities)
+        remaining = deadline - time.monotonic()
+        if rows or remaining <= 0:
+            return rows, more
+        # hand the connection back to the pool while waiting
+        db.session.rollback()
+        with new_changes:
+            new_changes.wait(min(remaining, POLL_INTERVAL))
+
+
+def prune(keep):
+    # drops all but the last keep changes; clients asking for anything
+    # older get a 410 and have to download everything again
+    last = db.session.query(func.max(Change.seq)).scalar() or 0
+    through = last - keep
+    if through <= pruned_through():
+        return 0
+
+    deleted = Change.query.filter(Change.seq <= through).delete(synchronize_session=False)
+    stat = Stat.query.get(PRUNED_THROUGH) or Stat(scope=PRUNED_THROUGH[0], key=PRUNED_THROUGH[1], name=PRUNED_THROUGH[2])
+    stat.value = through
+    db.session.add(stat)
+    db.session.commit()
+    return deleted
@@ -0,0 +1,21 @@
+import os
+
+
+class Config:
+    SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL')
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+
+    # GET/HEAD requests are sent here when it is set
+    DATABASE_REPLICA_URL = os.environ.get('DATABASE_REPLICA_URL')
+
+    # one connection per gunicorn thread, plus a little headroom for bursts
+    DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', os.environ.get('GUNICORN_THREADS', 5)))
+    DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 2))
+    DB_POOL_TIMEOUT = int(os.environ.get('DB_POOL_TIMEOUT', 10))
+    DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+    DB_POOL_PRE_PING = os.environ.get('DB_POOL_PRE_PING', 'true').lower() == 'true'
+    DB_STATEMENT_TIMEOUT_MS = int(os.environ.get('DB_STATEMENT_TIMEOUT_MS', 5000))
+
+    # whether DELETE /games also deletes the games' characters when the
+    # request does not say (?cascade=true/false)
+    DELETE_CASCADE = os.environ.get('DELETE_CASCADE', 'false').lower() == 'true'
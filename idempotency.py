@@ -0,0 +1,133 @@
+import hashlib
+import itertools
+import time
+from functools import wraps
+
+from flask import Response, abort, current_app, request
+from sqlalchemy import exc
+
+from models import db, IdempotencyKey
+
+DEFAULT_IDEMPOTENCY_TTL = 24 * 60 * 60
+MAX_KEY_LENGTH = 255
+# every PRUNE_EVERY reservations also delete up to PRUNE_BATCH expired keys,
+# so the table stays bounded without the prune-idempotency-keys command
+PRUNE_EVERY = 100
+PRUNE_BATCH = 1000
+
+reservations = itertools.count(1)
+
+
+'''
+Responses of create requests are kept by Idempotency-Key in the
+IdempotencyKey table, so every worker sees them. The key's row is inserted
+before the handler runs and commits together with the rows the handler
+creates: a retry on another worker waits on the primary key until then and
+either finds the row or, if the first request failed, takes the key itself.
+The response is stored on the row in a second, short transaction.
+'''
+def setup_idempotency(app):
+    app.config.setdefault('IDEMPOTENCY_TTL', DEFAULT_IDEMPOTENCY_TTL)
+
+
+def stored_key(payload, idempotency_key):
+    # keys are scoped to the caller (the token's sub) and the path
+    scoped = '\0'.join((payload.get('sub') or '', request.path, idempotency_key))
+    return hashlib.sha256(scoped.encode()).hexdigest()
+
+
+def reserve(key, fingerprint, ttl):
+    # the row a previous request left for key, or None after adding key to
+    # the session as pending; it is committed by the handler's own commit
+    if next(reservations) % PRUNE_EVERY == 0:
+        delete_expired(ttl, limit=PRUNE_BATCH)
+    now = time.time()
+    entry = IdempotencyKey.query.get(key)
+    if entry is not None and entry.created >= now - ttl:
+        return entry
+
+    if entry is None:
+        db.session.add(IdempotencyKey(key=key, fingerprint=fingerprint, created=now))
+    else:
+        # expired, start over
+        entry.fingerprint, entry.created, entry.status, entry.body, entry.mimetype = fingerprint, now, None, None, None
+    try:
+        db.session.flush()
+    except exc.IntegrityError:
+        # a concurrent request with the same key committed first
+        db.session.rollback()
+        entry = IdempotencyKey.query.get(key)
+        if entry is None:
+            abort(409)
+        return entry
+    return None
+
+
+def finish(key, response):
+    entry = IdempotencyKey.query.get(key)
+    entry.status = response.status_code
+    entry.body = response.get_data()
+    entry.mimetype = response.mimetype
+    db.session.commit()
+
+
+def abandon(key):
+    # lets the client retry: drops the key, even if the handler had already
+    # committed it before failing
+    db.session.rollback()
+    IdempotencyKey.query.filter(IdempotencyKey.key == key, IdempotencyKey.status.is_(None)).delete(
+        synchronize_session=False)
+    db.session.commit()
+
+
+def delete_expired(ttl, limit=None):
+    # the oldest limit expired keys, through the index on created
+    expired = IdempotencyKey.query.filter(IdempotencyKey.created < time.time() - ttl)
+    if limit is not None:
+        oldest = expired.with_entities(IdempotencyKey.key).order_by(IdempotencyKey.created).limit(limit)
+        expired = IdempotencyKey.query.filter(IdempotencyKey.key.in_(oldest.subquery()))
+    return expired.delete(synchronize_session=False)
+
+
+def prune(ttl):
+    deleted = delete_expired(ttl)
+    db.session.commit()
+    return deleted
+
+
+def idempotent(f):
+    # replays the stored response for a repeated Idempotency-Key. Goes below
+    # requires_auth, which passes the decoded payload as the first argument
+    @wraps(f)
+    def wrapper(payload, *args, **kwargs):
+        idempotency_key = request.headers.get('Idempotency-Key')
+        if idempotency_key is None:
+            return f(payload, *args, **kwargs)
+        if not idempotency_key or len(idempotency_key) > MAX_KEY_LENGTH:
+            abort(400)
+
+        key = stored_key(payload, idempotency_key)
+        fingerprint = hashlib.sha256(request.get_data()).hexdigest()
+
+        entry = reserve(key, fingerprint, current_app.config['IDEMPOTENCY_TTL'])
+        if entry is not None:
+            if entry.fingerprint != fingerprint:
+                # the same key sent with a different body
+                abort(422)
+            if entry.status is None:
+                abort(409)
+            response = Response(entry.body, status=entry.status, mimetype=entry.mimetype)
+            response.headers['Idempotent-Replayed'] = 'true'
+            return response
+
+        try:
+            response = current_app.make_response(f(payload, *args, **kwargs))
+        except Exception:
+            abandon(key)
+            raise
+        if response.status_code >= 500 or response.is_streamed:
+            abandon(key)
+        else:
+            finish(key, response)
+        return response
+    return wrapper
@@ -0,0 +1,14 @@
+'''
+Entry point for the flask command. Flask-Migrate, and Alembic with it, is
+only imported here, so serving processes never load the migration tooling.
+
+    FLASK_APP=manage.py flask db upgrade
+    FLASK_APP=manage.py flask rebuild-stats
+'''
+from flask_migrate import Migrate
+
+from app import create_app
+from models import db
+
+app = create_app()
+migrate = Migrate(app, db)
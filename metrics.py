@@ -0,0 +1,157 @@
+import os
+import threading
+import time
+from bisect import bisect_left
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+class Histogram:
+    # a Prometheus histogram; bucket counts are stored per bucket and only
+    # made cumulative when rendered, so observe() is one bisect and one lock
+
+    def __init__(self, name, help, labels, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, label_values, amount):
+        index = bisect_left(self.buckets, amount)
+        with self.lock:
+            series = self.series.get(label_values)
+            if series is None:
+                series = self.series[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += amount
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s histogram' % self.name]
+        with self.lock:
+            series = sorted((values, list(counts)) for values, counts in self.series.items())
+        for values, counts in series:
+            labels = ','.join('%s="%s"' % (label, value) for label, value in zip(self.labels, values))
+            total = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                total += count
+                lines.append('%s_bucket{%s,le="%s"} %d' % (self.name, labels, bound, total))
+            lines.append('%s_sum{%s} %f' % (self.name, labels, counts[-1]))
+            lines.append('%s_count{%s} %d' % (self.name, labels, total))
+        return lines
+
+
+request_seconds = Histogram(
+    'game_service_request_duration_seconds', 'Request latency.', ('route', 'method', 'status'))
+sql_statements = Histogram(
+    'game_service_request_sql_statements', 'SQL statements per request.', ('route', 'method'), QUERY_BUCKETS)
+sql_seconds = Histogram(
+    'game_service_request_sql_seconds', 'Time spent in SQL per request.', ('route', 'method'))
+auth_seconds = Histogram(
+    'game_service_request_auth_seconds', 'Time spent verifying the bearer token per request.', ('route', 'method'))
+serialize_seconds = Histogram(
+    'game_service_request_serialize_seconds', 'Time spent encoding the response body per request.', ('route', 'method'))
+
+HISTOGRAMS = [request_seconds, sql_statements, sql_seconds, auth_seconds, serialize_seconds]
+
+
+def add_time(name, seconds):
+    # accumulate a per-request timer, e.g. add_time('auth', ...)
+    if has_request_context():
+        timings = g.setdefault('timings', {})
+        timings[name] = timings.get(name, 0.0) + seconds
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info['query_start'] = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['query_start']
+    if has_request_context():
+        g.sql_statements = g.get('sql_statements', 0) + 1
+        add_time('db', elapsed)
+
+
+def server_timing(timings, statements, total):
+    parts = ['%s;dur=%.2f' % (name, seconds * 1000) for name, seconds in sorted(timings.items()) if name != 'db']
+    parts.append('db;dur=%.2f;desc="%d queries"' % (timings.get('db', 0.0) * 1000, statements))
+    parts.append('total;dur=%.2f' % (total * 1000))
+    return ', '.join(parts)
+
+
+def setup_metrics(app):
+    app.config.setdefault('SERVER_TIMING', os.environ.get('SERVER_TIMING', 'false').lower() == 'true')
+
+    @app.before_request
+    def start_timer():
+        g.request_start = time.perf_counter()
+
+    @app.after_request
+    def record_request(response):
+        start = g.get('request_start')
+        if start is None:
+            return response
+        total = time.perf_counter() - start
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        timings = g.get('timings', {})
+        statements = g.get('sql_statements', 0)
+
+        request_seconds.observe((route, request.method, str(response.status_code)), total)
+        sql_statements.observe((route, request.method), statements)
+        sql_seconds.observe((route, request.method), timings.get('db', 0.0))
+        auth_seconds.observe((route, request.method), timings.get('auth', 0.0))
+        serialize_seconds.observe((route, request.method), timings.get('serialize', 0.0))
+
+        if app.config['SERVER_TIMING']:
+            response.headers['Server-Timing'] = server_timing(timings, statements, total)
+        return response
+
+
+def render(pools=None, write_behind=None):
+    lines = []
+    for histogram in HISTOGRAMS:
+        lines.extend(histogram.render())
+
+    gauges = (
+        ('in_use', 'Connections checked out.'), ('idle', 'Connections idle in the pool.'),
+        ('overflow', 'Overflow connections open.'), ('size', 'Configured pool size.')
+    )
+    for key, help in gauges:
+        name = 'game_service_db_pool_%s' % key
+        lines += ['# HELP %s %s' % (name, help), '# TYPE %s gauge' % name]
+        lines += ['%s{pool="%s"} %d' % (name, pool, stats[key]) for pool, stats in sorted((pools or {}).items())]
+
+    counters = (
+        ('checkouts', 'checkouts_total', 'Connection checkouts.'), ('timeouts', 'timeouts_total', 'Checkouts that timed out.'),
+        ('wait_seconds_total', 'wait_seconds_total', 'Time spent waiting for a connection.')
+    )
+    for key, suffix, help in counters:
+        name = 'game_service_db_pool_%s' % suffix
+        lines += ['# HELP %s %s' % (name, help), '# TYPE %s counter' % name]
+        lines += ['%s{pool="%s"} %s' % (name, pool, stats[key]) for pool, stats in sorted((pools or {}).items())]
+
+    if write_behind is not None:
+        name = 'game_service_write_behind_depth'
+        lines += ['# HELP %s Game updates waiting to be written.' % name, '# TYPE %s gauge' % name]
+        lines.append('%s %d' % (name, write_behind['depth']))
+        queue_counters = (
+            ('accepted', 'Updates accepted into the queue.'), ('coalesced', 'Updates merged into one already queued.'),
+            ('written', 'Rows written.'), ('missing', 'Queued updates for games that no longer exist.'),
+            ('dropped', 'Queued updates the database rejected.'), ('batches', 'Batches committed.'),
+            ('failures', 'Batches that failed and were written again row by row.')
+        )
+        for key, help in queue_counters:
+            name = 'game_service_write_behind_%s_total' % key
+            lines += ['# HELP %s %s' % (name, help), '# TYPE %s counter' % name]
+            lines.append('%s %d' % (name, write_behind[key]))
+
+    return '\n'.join(lines) + '\n'
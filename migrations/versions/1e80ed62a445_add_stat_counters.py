@@ -0,0 +1,33 @@
+"""add Stat counters
+
+Run `flask rebuild-stats` once after upgrading a database that already has
+games and characters.
+
+Revision ID: 1e80ed62a445
+Revises: 43ca084fbb35
+Create Date: 2026-10-18 16:32:27.618044
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '1e80ed62a445'
+down_revision = '43ca084fbb35'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('Stat',
+    sa.Column('scope', sa.String(), nullable=False),
+    sa.Column('key', sa.String(), nullable=False),
+    sa.Column('name', sa.String(), nullable=False),
+    sa.Column('value', sa.BigInteger(), nullable=False),
+    sa.PrimaryKeyConstraint('scope', 'key', 'name')
+    )
+
+
+def downgrade():
+    op.drop_table('Stat')
@@ -0,0 +1,34 @@
+"""add the IdempotencyKey table shared by every worker
+
+Revision ID: 3f7a9c1b2d64
+Revises: 8d41b6c2e7f3
+Create Date: 2026-10-18 21:12:07.441915
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f7a9c1b2d64'
+down_revision = '8d41b6c2e7f3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('IdempotencyKey',
+    sa.Column('key', sa.String(length=64), nullable=False),
+    sa.Column('fingerprint', sa.String(length=64), nullable=False),
+    sa.Column('created', sa.Float(), nullable=False),
+    sa.Column('status', sa.Integer(), nullable=True),
+    sa.Column('body', sa.LargeBinary(), nullable=True),
+    sa.Column('mimetype', sa.String(), nullable=True),
+    sa.PrimaryKeyConstraint('key')
+    )
+    op.create_index(op.f('ix_IdempotencyKey_created'), 'IdempotencyKey', ['created'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_IdempotencyKey_created'), table_name='IdempotencyKey')
+    op.drop_table('IdempotencyKey')
@@ -0,0 +1,29 @@
+"""add search indexes
+
+Revision ID: 43ca084fbb35
+Revises: 91ad440578f3
+Create Date: 2026-10-18 16:11:15.902364
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '43ca084fbb35'
+down_revision = '91ad440578f3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    op.create_index('ix_game_title_trgm', 'Game', ['title'], unique=False, postgresql_using='gin', postgresql_ops={'title': 'gin_trgm_ops'})
+    op.create_index('ix_game_genres_gin', 'Game', ['genres'], unique=False, postgresql_using='gin')
+    op.create_index('ix_character_name_trgm', 'Character', ['name'], unique=False, postgresql_using='gin', postgresql_ops={'name': 'gin_trgm_ops'})
+
+
+def downgrade():
+    op.drop_index('ix_character_name_trgm', table_name='Character')
+    op.drop_index('ix_game_genres_gin', table_name='Game')
+    op.drop_index('ix_game_title_trgm', table_name='Game')
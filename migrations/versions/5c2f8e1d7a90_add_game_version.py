@@ -0,0 +1,24 @@
+"""add Game.version for If-Match on PATCH
+
+Revision ID: 5c2f8e1d7a90
+Revises: 1e80ed62a445
+Create Date: 2026-10-18 16:58:04.311207
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5c2f8e1d7a90'
+down_revision = '1e80ed62a445'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('Game', sa.Column('version', sa.Integer(), server_default='1', nullable=False))
+
+
+def downgrade():
+    op.drop_column('Game', 'version')
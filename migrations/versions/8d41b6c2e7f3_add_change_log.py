@@ -0,0 +1,31 @@
+"""add the Change log behind GET /changes
+
+Revision ID: 8d41b6c2e7f3
+Revises: 5c2f8e1d7a90
+Create Date: 2026-10-18 17:41:52.903318
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8d41b6c2e7f3'
+down_revision = '5c2f8e1d7a90'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('Change',
+    sa.Column('seq', sa.BigInteger(), nullable=False),
+    sa.Column('entity', sa.String(), nullable=False),
+    sa.Column('entity_id', sa.Integer(), nullable=False),
+    sa.Column('op', sa.String(), nullable=False),
+    sa.Column('data', sa.JSON(), nullable=True),
+    sa.PrimaryKeyConstraint('seq')
+    )
+
+
+def downgrade():
+    op.drop_table('Change')
@@ -0,0 +1,30 @@
+"""add list filter indexes
+
+Revision ID: 91ad440578f3
+Revises: b3da517b989e
+Create Date: 2026-10-18 16:10:41.530977
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '91ad440578f3'
+down_revision = 'b3da517b989e'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_game_completed_id', 'Game', ['completed', 'id'], unique=False)
+    op.create_index('ix_game_rating_id', 'Game', ['rating', 'id'], unique=False)
+    op.create_index('ix_character_game_id_id', 'Character', ['game_id', 'id'], unique=False)
+    op.create_index('ix_character_good_id', 'Character', ['good', 'id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_character_good_id', table_name='Character')
+    op.drop_index('ix_character_game_id_id', table_name='Character')
+    op.drop_index('ix_game_rating_id', table_name='Game')
+    op.drop_index('ix_game_completed_id', table_name='Game')
@@ -0,0 +1,45 @@
+"""create Game and Character
+
+Databases created earlier with db.create_all() already have these tables;
+mark them as migrated with `flask db stamp b3da517b989e`.
+
+Revision ID: b3da517b989e
+Revises: 
+Create Date: 2026-10-18 16:10:02.114210
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = 'b3da517b989e'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('Game',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('title', sa.String(), nullable=True),
+    sa.Column('genres', postgresql.ARRAY(sa.String()), nullable=True),
+    sa.Column('rating', sa.Integer(), nullable=True),
+    sa.Column('completed', sa.Boolean(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table('Character',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('name', sa.String(), nullable=True),
+    sa.Column('fighting', sa.Integer(), nullable=True),
+    sa.Column('intelligence', sa.Integer(), nullable=True),
+    sa.Column('good', sa.Boolean(), nullable=False),
+    sa.Column('game_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['game_id'], ['Game.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+
+
+def downgrade():
+    op.drop_table('Character')
+    op.drop_table('Game')
@@ -1,37 +1,353 @@
 import os
-from sqlalchemy import Column, String, Integer, Enum
-from flask_sqlalchemy import SQLAlchemy
-import json
-from flask_migrate import Migrate
-# from app import app
+import threading
+import time
+from sqlalchemy import Column, String, Integer, Enum, DDL, case, event, exc, func, orm, select
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.pool import QueuePool
+from flask import has_request_context, request
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from config import Config
 
 database_name = "capstone"
 database_path = os.environ.get('DATABASE_URL')
 
-db = SQLAlchemy()
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+STREAM_BATCH_SIZE = 1000
+BULK_BATCH_SIZE = 1000
+# items accepted by one bulk create request
+MAX_BULK_ITEMS = 10000
+READ_METHODS = ('GET', 'HEAD')
+
+
+class RoutingSession(SignallingSession):
+    # sends the reads of GET/HEAD requests to the replica bind when one is
+    # configured; anything that flushes still goes to the primary
+
+    def __init__(self, db, **options):
+        self.db = db
+        SignallingSession.__init__(self, db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        if (self.app.config.get('DATABASE_REPLICA_URL') and not self._flushing
+                and has_request_context() and request.method in READ_METHODS):
+            return self.db.get_engine(self.app, bind='replica')
+        return SignallingSession.get_bind(self, mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+db = RoutingSQLAlchemy()
 
 # setup_db(app)
 
 
-def setup_db(app):
-    # app.config["SQLALCHEMY_DATABASE_URI"] = database_path
-    # app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
-    # app.config.from_object('config')
+class PoolStats:
+    def __init__(self):
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.lock = threading.Lock()
+
+    def record(self, wait, timed_out=False):
+        with self.lock:
+            self.checkouts += 1
+            self.timeouts += timed_out
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+
+
+class TimedQueuePool(QueuePool):
+    # QueuePool that records how long each checkout waited for a connection
+
+    def __init__(self, *args, **kwargs):
+        QueuePool.__init__(self, *args, **kwargs)
+        self.stats = PoolStats()
+
+    def _do_get(self):
+        start = time.perf_counter()
+        timed_out = False
+        try:
+            return QueuePool._do_get(self)
+        except exc.TimeoutError:
+            timed_out = True
+            raise
+        finally:
+            self.stats.record(time.perf_counter() - start, timed_out)
+
+
+def engine_options(config):
+    uri = config.get('SQLALCHEMY_DATABASE_URI')
+    if not uri or uri.startswith('sqlite'):
+        return {}
+
+    options = {
+        'poolclass': TimedQueuePool,
+        'pool_size': config['DB_POOL_SIZE'],
+        'max_overflow': config['DB_MAX_OVERFLOW'],
+        'pool_timeout': config['DB_POOL_TIMEOUT'],
+        'pool_recycle': config['DB_POOL_RECYCLE'],
+        'pool_pre_ping': config['DB_POOL_PRE_PING'],
+    }
+    if uri.startswith('postgres') and config['DB_STATEMENT_TIMEOUT_MS']:
+        options['connect_args'] = {'options': '-c statement_timeout=%d' % config['DB_STATEMENT_TIMEOUT_MS']}
+    return options
+
+
+def setup_db(app, database_path=None, config=Config):
+    # values already in app.config (e.g. create_app's test_config) win
+    for key in dir(config):
+        if key.isupper():
+            app.config.setdefault(key, getattr(config, key))
+    if database_path is not None:
+        app.config["SQLALCHEMY_DATABASE_URI"] = database_path
+    if app.config.get("SQLALCHEMY_DATABASE_URI") is None:
+        # let Flask-SQLAlchemy warn and fall back to its default
+        del app.config["SQLALCHEMY_DATABASE_URI"]
+    if app.config.get('DATABASE_REPLICA_URL'):
+        app.config['SQLALCHEMY_BINDS'] = {'replica': app.config['DATABASE_REPLICA_URL']}
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config)
     db.app=app
     db.init_app(app)
-    migrate = Migrate(app, db)
 
 
+def pool_stats(app=None):
+    binds = [None]
+    if (app or db.get_app()).config.get('DATABASE_REPLICA_URL'):
+        binds.append('replica')
+
+    pools = {}
+    for bind in binds:
+        pool = db.get_engine(app, bind=bind).pool
+        if not isinstance(pool, TimedQueuePool):
+            continue
+        pools[bind or 'primary'] = {
+            'size': pool.size(),
+            'in_use': pool.checkedout(),
+            'idle': pool.checkedin(),
+            'overflow': pool.overflow(),
+            'checkouts': pool.stats.checkouts,
+            'timeouts': pool.stats.timeouts,
+            'wait_seconds_total': pool.stats.wait_total,
+            'wait_seconds_max': pool.stats.wait_max
+        }
+    return pools
+
+
+# the trigram indexes need pg_trgm; migrations create it too
+event.listen(db.Model.metadata, 'before_create', DDL('CREATE EXTENSION IF NOT EXISTS pg_trgm').execute_if(dialect='postgresql'))
+
+
+def paginate(query, model, after=None, limit=DEFAULT_PAGE_SIZE):
+    # keyset pagination on the primary key: the id of the last row of the
+    # previous page is the cursor, so every page is an index range scan
+    if after is not None:
+        query = query.filter(model.id > after)
+    rows = query.order_by(model.id).limit(limit + 1).all()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = rows[-1].id
+
+    return rows, next_cursor
+
+
+def paginate_ranked(query, offset=0, limit=DEFAULT_PAGE_SIZE):
+    # ranked results have no stable key to seek on, so the cursor is an offset
+    rows = query.offset(offset).limit(limit + 1).all()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = offset + limit
+
+    return rows, next_cursor
+
+
+def like_escape(text):
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def text_search(query, model, column, text, prefix=False):
+    # ILIKE and similarity() are both served by the column's pg_trgm GIN
+    # index; prefix matches rank first, then the closest trigram matches
+    pattern = like_escape(text) + '%'
+    if not prefix:
+        pattern = '%' + pattern
+    starts_with = case([(column.ilike(like_escape(text) + '%', escape='\\'), 1)], else_=0)
+    return query.filter(column.ilike(pattern, escape='\\')).order_by(
+        starts_with.desc(), func.similarity(column, text).desc(), model.id)
+
+
+def stream(query, model, after=None, batch_size=STREAM_BATCH_SIZE):
+    # yield_per turns on a server-side cursor (stream_results) and hydrates
+    # batch_size rows at a time, so memory stays flat for any table size
+    if after is not None:
+        query = query.filter(model.id > after)
+    return query.order_by(model.id).yield_per(batch_size)
+
+
+def bulk_insert(model, rows, batch_size=BULK_BATCH_SIZE, on_insert=None):
+    # one multi-row INSERT ... RETURNING id per batch, all in one transaction;
+    # on_insert(ids) runs just before the commit
+    table = model.__table__
+    ids = []
+    try:
+        for start in range(0, len(rows), batch_size):
+            statement = table.insert().values(rows[start:start + batch_size]).returning(table.c.id)
+            ids.extend(row[0] for row in db.session.execute(statement))
+        if on_insert is not None:
+            on_insert(ids)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return ids
+
+
+def update_if_version(model, id, version, values, fields):
+    '''
+    One UPDATE ... WHERE id = :id AND version = :version (any version when
+    version is None) that also bumps the version. On Postgres the previous
+    values come from a locked subselect in the same statement, so there is
+    no read-then-write round trip. Returns (previous, current, new version),
+    previous/current holding fields, or None when no row matched. The caller
+    commits.
+    '''
+    table = model.__table__
+    mapper = orm.class_mapper(model)
+    values = dict(values, version=table.c.version + 1)
+    matches = table.c.id == id
+    if version is not None:
+        matches &= table.c.version == version
+
+    if db.session.connection(mapper=mapper).dialect.name == 'postgresql':
+        previous = select([table.c.id] + [table.c[field] for field in fields]).where(
+            table.c.id == id).with_for_update().alias('previous')
+        statement = table.update().where(matches & (table.c.id == previous.c.id)).values(**values).returning(
+            table.c.version, *([previous.c[field].label('previous_' + field) for field in fields] +
+                               [table.c[field] for field in fields]))
+        row = db.session.execute(statement, mapper=mapper).first()
+        if row is None:
+            return None
+        return (
+            {field: row['previous_' + field] for field in fields},
+            {field: row[field] for field in fields},
+            row['version']
+        )
+
+    # other databases (sqlite in tests and benchmarks) read the row first
+    columns = [table.c[field] for field in fields]
+    row = db.session.execute(select(columns).where(matches), mapper=mapper).first()
+    if row is None:
+        return None
+    previous = dict(zip(fields, row))
+    db.session.execute(table.update().where(matches).values(**values), mapper=mapper)
+    row = db.session.execute(select([table.c.version] + columns).where(table.c.id == id), mapper=mapper).first()
+    return previous, dict(zip(fields, row[1:])), row[0]
+
+
+def delete_returning(model, where, fields):
+    # one DELETE ... RETURNING fields; other databases (sqlite in tests and
+    # benchmarks) select the rows first. The caller commits
+    table = model.__table__
+    mapper = orm.class_mapper(model)
+    columns = [table.c[field] for field in fields]
+    if db.session.connection(mapper=mapper).dialect.name == 'postgresql':
+        rows = db.session.execute(table.delete().where(where).returning(*columns), mapper=mapper)
+    else:
+        rows = db.session.execute(select(columns).where(where), mapper=mapper).fetchall()
+        db.session.execute(table.delete().where(where), mapper=mapper)
+    return [dict(zip(fields, row)) for row in rows]
+
+
+# the range of a Postgres integer column; a value outside it fails the
+# whole statement
+MIN_INT = -2 ** 31
+MAX_INT = 2 ** 31 - 1
+
+
+def is_int(value):
+    return isinstance(value, int) and not isinstance(value, bool) and MIN_INT <= value <= MAX_INT
+
 
 class Game(db.Model):
     __tablename__ = 'Game'
 
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String)
-    genres = db.Column(db.ARRAY(db.String))
+    # the postgresql ARRAY type, the generic one has no contains() (@>);
+    # JSON on sqlite so the test and benchmark stand-in can store genres
+    genres = db.Column(ARRAY(db.String).with_variant(db.JSON, 'sqlite'))
     rating = db.Column(db.Integer)
     completed = db.Column(db.Boolean, nullable=False, default=False)
+    # bumped by every PATCH, compared against If-Match
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+    # passive_deletes leaves the game's characters to the database on delete
+    # instead of loading them just to null out their game_id
+    characters = db.relationship('Character', backref='game', order_by='Character.id', passive_deletes=True)
+
+    # output key -> attribute, in the same shape as short() and full()
+    FIELDS = {
+        'short': (('id', 'id'), ('title', 'title')),
+        'full': (('id', 'id'), ('title', 'title'), ('completed', 'completed'), ('genres', 'genres'), ('rating', 'rating'),
+                 ('version', 'version'))
+    }
+
+    __table_args__ = (
+        db.Index('ix_game_completed_id', 'completed', 'id'),
+        db.Index('ix_game_rating_id', 'rating', 'id'),
+        db.Index('ix_game_title_trgm', 'title', postgresql_using='gin', postgresql_ops={'title': 'gin_trgm_ops'}),
+        db.Index('ix_game_genres_gin', 'genres', postgresql_using='gin'),
+    )
+
+    @classmethod
+    def filtered(cls, genre=None, completed=None, min_rating=None, max_rating=None):
+        query = cls.query
+        if genre is not None:
+            query = query.filter(cls.genres.contains([genre]))
+        if completed is not None:
+            query = query.filter(cls.completed == completed)
+        if min_rating is not None:
+            query = query.filter(cls.rating >= min_rating)
+        if max_rating is not None:
+            query = query.filter(cls.rating <= max_rating)
+        return query
+
+    @classmethod
+    def search(cls, text=None, genres=None, prefix=False):
+        query = cls.query
+        if genres:
+            # genres @> ARRAY[...], served by the GIN index on genres
+            query = query.filter(cls.genres.contains(genres))
+        if text:
+            return text_search(query, cls, cls.title, text, prefix)
+        return query.order_by(cls.id)
 
+    @staticmethod
+    def bulk_row(data):
+        if not isinstance(data, dict):
+            raise ValueError('game must be an object')
+        title = data.get('title')
+        genres = data.get('genres')
+        rating = data.get('rating')
+        completed = data.get('completed', False)
+
+        if not isinstance(title, str):
+            raise ValueError('title must be a string')
+        if genres is not None and not (isinstance(genres, list) and all(isinstance(g, str) for g in genres)):
+            raise ValueError('genres must be a list of strings')
+        if rating is not None and not is_int(rating):
+            raise ValueError('rating must be an integer')
+        if not isinstance(completed, bool):
+            raise ValueError('completed must be a boolean')
+
+        return {'title': title, 'genres': genres, 'rating': rating, 'completed': completed, 'version': 1}
 
     def full(self):
         return {
@@ -39,7 +355,8 @@ class Game(db.Model):
             "title": self.title,
             "completed": self.completed,
             "genres": self.genres,
-            "rating": self.rating
+            "rating": self.rating,
+            "version": self.version
         }
     
     def short(self):
@@ -48,6 +365,49 @@ class Game(db.Model):
             "title": self.title
         }
 
+    @classmethod
+    def delete_many(cls, ids, fields, cascade=False):
+        '''
+        Deletes the games with these ids without loading them and returns
+        fields of each deleted game plus 'character_ids', the ids of its
+        characters deleted along with it. Without cascade a game that still
+        has characters fails the foreign key (IntegrityError); with cascade
+        they go in the same statement, a data-modifying WITH on Postgres.
+        The caller commits.
+        '''
+        games = cls.__table__
+        characters = Character.__table__
+        mapper = orm.class_mapper(cls)
+
+        if not cascade:
+            return [dict(game, character_ids=[]) for game in delete_returning(cls, games.c.id.in_(ids), fields)]
+
+        if db.session.connection(mapper=mapper).dialect.name == 'postgresql':
+            # the foreign key is only checked at the end of the statement,
+            # once both deletes have run
+            deleted_characters = characters.delete().where(characters.c.game_id.in_(ids)).returning(
+                characters.c.id, characters.c.game_id).cte('deleted_characters')
+            deleted_games = games.delete().where(games.c.id.in_(ids)).returning(
+                *[games.c[field] for field in fields]).cte('deleted_games')
+            character_ids = select([func.array_agg(deleted_characters.c.id)]).where(
+                deleted_characters.c.game_id == deleted_games.c.id).as_scalar().label('character_ids')
+            rows = db.session.execute(
+                select([deleted_games.c[field] for field in fields] + [character_ids]), mapper=mapper)
+            return [dict(zip(fields, row[:-1]), character_ids=row[-1] or []) for row in rows]
+
+        character_ids = {}
+        for character in delete_returning(Character, characters.c.game_id.in_(ids), ('id', 'game_id')):
+            character_ids.setdefault(character['game_id'], []).append(character['id'])
+        return [
+            dict(game, character_ids=character_ids.get(game['id'], []))
+            for game in delete_returning(cls, games.c.id.in_(ids), fields)
+        ]
+
+    def with_characters(self):
+        game = self.full()
+        game["characters"] = [character.full() for character in self.characters]
+        return game
+
     def insert(self):
         db.session.add(self)
         db.session.commit()
@@ -70,6 +430,56 @@ class Character(db.Model):
     good = db.Column(db.Boolean, nullable=False, default=True)
     game_id = db.Column(db.Integer, db.ForeignKey('Game.id'), nullable=False)
 
+    FIELDS = {
+        'short': (('id', 'id'), ('title', 'name')),
+        'full': (('id', 'id'), ('name', 'name'), ('fighting', 'fighting'), ('intelligence', 'intelligence'), ('good', 'good'), ('game_id', 'game_id'))
+    }
+
+    __table_args__ = (
+        db.Index('ix_character_game_id_id', 'game_id', 'id'),
+        db.Index('ix_character_good_id', 'good', 'id'),
+        db.Index('ix_character_name_trgm', 'name', postgresql_using='gin', postgresql_ops={'name': 'gin_trgm_ops'}),
+    )
+
+    @classmethod
+    def filtered(cls, game_id=None, good=None):
+        query = cls.query
+        if game_id is not None:
+            query = query.filter(cls.game_id == game_id)
+        if good is not None:
+            query = query.filter(cls.good == good)
+        return query
+
+    @classmethod
+    def search(cls, text, game_id=None, prefix=False):
+        query = cls.query
+        if game_id is not None:
+            query = query.filter(cls.game_id == game_id)
+        return text_search(query, cls, cls.name, text, prefix)
+
+    @staticmethod
+    def bulk_row(data):
+        if not isinstance(data, dict):
+            raise ValueError('character must be an object')
+        name = data.get('name')
+        fighting = data.get('fighting')
+        intelligence = data.get('intelligence')
+        good = data.get('good', True)
+        game_id = data.get('game_id')
+
+        if not isinstance(name, str):
+            raise ValueError('name must be a string')
+        if fighting is not None and not is_int(fighting):
+            raise ValueError('fighting must be an integer')
+        if intelligence is not None and not is_int(intelligence):
+            raise ValueError('intelligence must be an integer')
+        if not isinstance(good, bool):
+            raise ValueError('good must be a boolean')
+        if not is_int(game_id):
+            raise ValueError('game_id must be an integer')
+
+        return {'name': name, 'fighting': fighting, 'intelligence': intelligence, 'good': good, 'game_id': game_id}
+
     def full(self):
         return {
             "id": self.id,
@@ -87,11 +497,8 @@ class Character(db.Model):
         }
 
     def insert(self):
-        print("4")
         db.session.add(self)
-        print("5")
         db.session.commit()
-        print("6")
 
     def update(self):
         db.session.commit()
@@ -101,10 +508,47 @@ class Character(db.Model):
         db.session.commit()
 
 
+class Stat(db.Model):
+    # incrementally maintained counters behind GET /stats, see stats.py.
+    # scope is 'all', 'genre' (key is the genre) or 'game' (key is the id)
+    __tablename__ = 'Stat'
 
+    scope = db.Column(db.String, primary_key=True)
+    key = db.Column(db.String, primary_key=True)
+    name = db.Column(db.String, primary_key=True)
+    value = db.Column(db.BigInteger, nullable=False, default=0)
 
 
+class Change(db.Model):
+    # the change feed behind GET /changes, see changes.py. op is 'upsert'
+    # with the row's full() as data, or 'delete' with no data (a tombstone)
+    __tablename__ = 'Change'
 
+    seq = db.Column(db.BigInteger().with_variant(db.Integer, 'sqlite'), primary_key=True)
+    entity = db.Column(db.String, nullable=False)
+    entity_id = db.Column(db.Integer, nullable=False)
+    op = db.Column(db.String, nullable=False)
+    data = db.Column(db.JSON)
+
+    def full(self):
+        return {
+            "seq": self.seq,
+            "entity": self.entity,
+            "id": self.entity_id,
+            "op": self.op,
+            "data": self.data
+        }
 
 
+class IdempotencyKey(db.Model):
+    # responses of create requests by Idempotency-Key, see idempotency.py.
+    # key is a sha256 of the caller, path and header; status is None while
+    # the first request runs
+    __tablename__ = 'IdempotencyKey'
 
+    key = db.Column(db.String(64), primary_key=True)
+    fingerprint = db.Column(db.String(64), nullable=False)
+    created = db.Column(db.Float, nullable=False, index=True)
+    status = db.Column(db.Integer)
+    body = db.Column(db.LargeBinary)
+    mimetype = db.Column(db.String)
@@ -0,0 +1,177 @@
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from flask import abort, current_app, g
+
+# requests per period for each route class; every GET is a list request
+DEFAULT_RATE_LIMITS = {'list': '600/minute', 'write': '120/minute', 'delete': '60/minute'}
+DEFAULT_RATE_LIMIT_MAX_CLIENTS = 100000
+PERIODS = {'second': 1, 'minute': 60, 'hour': 3600, 'day': 86400}
+
+
+def parse_limit(limit):
+    # '600/minute' -> (600, 60): a bucket of 600 requests refilled over a minute
+    count, _, period = limit.partition('/')
+    return int(count), PERIODS[period.strip()]
+
+
+class Bucket:
+    __slots__ = ('tokens', 'updated', 'full_at')
+
+    def __init__(self, tokens, updated, full_at):
+        self.tokens = tokens
+        self.updated = updated
+        self.full_at = full_at
+
+
+class MemoryRateLimiter:
+    '''
+    Token buckets per client and route class, in an OrderedDict with the
+    most recently used last, so a check is a lookup and a move_to_end.
+    Buckets that have refilled are dropped from the front (a missing bucket
+    starts full, so nothing is lost) and max_clients caps the total.
+    '''
+
+    def __init__(self, max_clients=DEFAULT_RATE_LIMIT_MAX_CLIENTS):
+        self.max_clients = max_clients
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def take(self, key, capacity, period, cost=1):
+        # (allowed, tokens left)
+        now = time.monotonic()
+        rate = capacity / period
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                tokens = capacity
+            else:
+                tokens = min(capacity, bucket.tokens + (now - bucket.updated) * rate)
+            allowed = tokens >= cost
+            if allowed:
+                tokens -= cost
+            self.buckets[key] = Bucket(tokens, now, now + (capacity - tokens) / rate)
+            self.buckets.move_to_end(key)
+            self._evict(now)
+        return allowed, tokens
+
+    def _evict(self, now):
+        while self.buckets:
+            key, bucket = next(iter(self.buckets.items()))
+            if bucket.full_at > now and len(self.buckets) <= self.max_clients:
+                return
+            del self.buckets[key]
+
+    def clear(self):
+        with self.lock:
+            self.buckets.clear()
+
+
+class RedisRateLimiter:
+    # shared buckets for several workers/nodes: a hash per bucket, updated by
+    # a Lua script so the refill and the take are atomic, expiring once full
+
+    SCRIPT = '''
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local cost = tonumber(ARGV[4])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(bucket[1]) or capacity
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate)
+local allowed = 0
+if tokens >= cost then
+  tokens = tokens - cost
+  allowed = 1
+end
+redis.call('HMSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil((capacity - tokens) / rate * 1000) + 1000)
+return {allowed, tostring(tokens)}
+'''
+
+    def __init__(self, url, prefix='game-service:ratelimit'):
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+        self.script = self.client.register_script(self.SCRIPT)
+
+    def take(self, key, capacity, period, cost=1):
+        allowed, tokens = self.script(
+            keys=['%s:%s' % (self.prefix, key)], args=[capacity, capacity / period, time.time(), cost])
+        return bool(allowed), float(tokens)
+
+    def clear(self):
+        for bucket_key in self.client.scan_iter('%s:*' % self.prefix):
+            self.client.delete(bucket_key)
+
+
+def setup_rate_limits(app):
+    app.config.setdefault('RATE_LIMIT_ENABLED', os.environ.get('RATE_LIMIT_ENABLED', 'true').lower() == 'true')
+    app.config.setdefault('RATE_LIMIT_BY', os.environ.get('RATE_LIMIT_BY', 'sub'))
+    for route_class, limit in DEFAULT_RATE_LIMITS.items():
+        name = 'RATE_LIMIT_' + route_class.upper()
+        app.config.setdefault(name, os.environ.get(name, limit))
+    app.config.setdefault('RATE_LIMIT_MAX_CLIENTS', DEFAULT_RATE_LIMIT_MAX_CLIENTS)
+    app.config.setdefault('RATE_LIMIT_REDIS_URL', os.environ.get('RATE_LIMIT_REDIS_URL'))
+
+    if app.config['RATE_LIMIT_REDIS_URL']:
+        limiter = RedisRateLimiter(app.config['RATE_LIMIT_REDIS_URL'])
+    else:
+        limiter = MemoryRateLimiter(max_clients=app.config['RATE_LIMIT_MAX_CLIENTS'])
+
+    app.extensions['rate_limiter'] = limiter
+
+    @app.after_request
+    def add_rate_limit_headers(response):
+        # on every response that took a token, errors from abort() included
+        headers = g.pop('rate_limit_headers', None)
+        if headers is not None:
+            response.headers.extend(headers)
+        return response
+
+    return limiter
+
+
+def client_key(payload):
+    # the token's sub, or its permission set, which puts every token of a
+    # role in one bucket (also used for tokens without a sub)
+    if current_app.config['RATE_LIMIT_BY'] == 'permissions' or not payload.get('sub'):
+        return 'permissions:' + ','.join(sorted(payload.get('permissions', [])))
+    return 'sub:' + payload['sub']
+
+
+def rate_limit_headers(capacity, period, tokens):
+    return {
+        'RateLimit-Limit': str(capacity),
+        'RateLimit-Remaining': str(int(tokens)),
+        'RateLimit-Reset': str(math.ceil((capacity - tokens) * period / capacity)),
+        'RateLimit-Policy': '%d;w=%d' % (capacity, period)
+    }
+
+
+def rate_limited(route_class):
+    # takes a token from the caller's bucket for route_class, or answers 429
+    # with Retry-After. Goes below requires_auth, which passes the decoded
+    # payload as the first argument
+    def decorator(f):
+        @wraps(f)
+        def wrapper(payload, *args, **kwargs):
+            if not current_app.config.get('RATE_LIMIT_ENABLED'):
+                return f(payload, *args, **kwargs)
+
+            capacity, period = parse_limit(current_app.config['RATE_LIMIT_' + route_class.upper()])
+            limiter = current_app.extensions['rate_limiter']
+            allowed, tokens = limiter.take('%s:%s' % (route_class, client_key(payload)), capacity, period)
+            g.rate_limit_headers = rate_limit_headers(capacity, period, tokens)
+            if not allowed:
+                g.rate_limit_headers['Retry-After'] = str(math.ceil((1 - tokens) * period / capacity))
+                abort(429)
+            return f(payload, *args, **kwargs)
+        return wrapper
+    return decorator
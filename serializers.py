@@ -0,0 +1,53 @@
+import json
+import time
+
+from flask import Response
+
+from metrics import add_time
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def dumps(obj):
+    # orjson when it is installed, the stdlib encoder otherwise; both give bytes
+    start = time.perf_counter()
+    if orjson is not None:
+        body = orjson.dumps(obj)
+    else:
+        body = json.dumps(obj, separators=(',', ':')).encode()
+    add_time('serialize', time.perf_counter() - start)
+    return body
+
+
+def json_response(payload, status=200):
+    return Response(dumps(payload), status=status, mimetype='application/json')
+
+
+def select_fields(model, fields=None):
+    '''
+    Columns for a fields= value: 'full' (the default) and 'short' match the
+    model's full() and short(), anything else is a comma separated subset of
+    the full() keys. id is always selected since it is the page cursor.
+    Raises ValueError for unknown fields.
+    '''
+    if fields is None or fields == 'full':
+        pairs = model.FIELDS['full']
+    elif fields == 'short':
+        pairs = model.FIELDS['short']
+    else:
+        names = set(fields.split(','))
+        if not names <= {key for key, attr in model.FIELDS['full']}:
+            raise ValueError('unknown field')
+        pairs = [(key, attr) for key, attr in model.FIELDS['full'] if key == 'id' or key in names]
+
+    return [getattr(model, attr).label(key) for key, attr in pairs]
+
+
+def row_dicts(columns, rows):
+    # plain tuples from query.with_entities(*columns), no ORM objects involved
+    keys = [column.key for column in columns]
+    for row in rows:
+        yield dict(zip(keys, row))
@@ -0,0 +1,205 @@
+from collections import Counter
+
+from sqlalchemy import event, inspect, select
+from sqlalchemy.dialects.postgresql import insert
+
+from models import db, delete_returning, stream, Character, Game, RoutingSession, Stat
+
+GAME_FIELDS = ('genres', 'rating', 'completed')
+CHARACTER_FIELDS = ('fighting', 'intelligence', 'good', 'game_id')
+
+
+'''
+Counters are collected per session while rows are flushed (or passed in by
+the bulk endpoints) and written with a single upsert right before the
+transaction commits, so they always move together with the rows they count.
+'''
+def pending(session):
+    return session.info.setdefault('stat_deltas', Counter())
+
+
+def count_game(deltas, game, sign):
+    scopes = [('all', '')] + [('genre', genre) for genre in game['genres'] or []]
+    for scope in scopes:
+        deltas[scope + ('games',)] += sign
+        if game['completed']:
+            deltas[scope + ('completed',)] += sign
+        if game['rating'] is not None:
+            deltas[scope + ('rated',)] += sign
+            deltas[scope + ('rating_sum',)] += sign * game['rating']
+            deltas[scope + ('rating:%d' % game['rating'],)] += sign
+
+
+def count_character(deltas, character, sign):
+    # per genre character counters are derived from the per game ones at
+    # commit, see count_genres
+    for scope in [('all', ''), ('game', str(character['game_id']))]:
+        deltas[scope + ('characters',)] += sign
+        if character['good']:
+            deltas[scope + ('good',)] += sign
+        for field in ('fighting', 'intelligence'):
+            if character[field] is not None:
+                deltas[scope + (field + '_count',)] += sign
+                deltas[scope + (field + '_sum',)] += sign * character[field]
+
+
+COUNTERS = {Game: (GAME_FIELDS, count_game), Character: (CHARACTER_FIELDS, count_character)}
+
+
+def track_rows(model, rows, sign=1):
+    # for writes that bypass the ORM, e.g. bulk_insert
+    fields, count = COUNTERS[model]
+    deltas = pending(db.session())
+    for row in rows:
+        count(deltas, row, sign)
+
+
+def current_values(obj, fields):
+    return {field: getattr(obj, field) for field in fields}
+
+
+def previous_values(obj, fields):
+    state = inspect(obj)
+    values = {}
+    for field in fields:
+        history = state.attrs[field].history
+        values[field] = history.deleted[0] if history.deleted else getattr(obj, field)
+    return values
+
+
+def forget_games(games):
+    # characters deleted along with their game are never returned, but the
+    # game's own counters are exactly their totals: take those off 'all' and
+    # the game's genres and drop them
+    if not games:
+        return
+    deltas = pending(db.session())
+    genres = {str(game['id']): game['genres'] or [] for game in games}
+    for row in delete_returning(Stat, (Stat.scope == 'game') & Stat.key.in_(list(genres)), ('key', 'name', 'value')):
+        for scope in [('all', '')] + [('genre', genre) for genre in genres[row['key']]]:
+            deltas[scope + (row['name'],)] -= row['value']
+
+
+def count_genres(connection, deltas):
+    # a game's genres can't be patched, so the character counters of each
+    # genre move with the per game ones: one lookup of the games involved
+    by_game = {}
+    for (scope, key, name), value in deltas.items():
+        if scope == 'game' and value:
+            by_game.setdefault(int(key), []).append((name, value))
+    if not by_game:
+        return
+
+    games = Game.__table__
+    for id, genres in connection.execute(select([games.c.id, games.c.genres]).where(games.c.id.in_(list(by_game)))):
+        for genre in genres or []:
+            for name, value in by_game[id]:
+                deltas[('genre', genre, name)] += value
+
+
+@event.listens_for(RoutingSession, 'after_flush')
+def collect(session, flush_context):
+    deltas = pending(session)
+    for obj in session.new:
+        if type(obj) in COUNTERS:
+            fields, count = COUNTERS[type(obj)]
+            count(deltas, current_values(obj, fields), 1)
+    for obj in session.deleted:
+        if type(obj) in COUNTERS:
+            fields, count = COUNTERS[type(obj)]
+            count(deltas, previous_values(obj, fields), -1)
+    for obj in session.dirty:
+        if type(obj) in COUNTERS and session.is_modified(obj):
+            fields, count = COUNTERS[type(obj)]
+            count(deltas, previous_values(obj, fields), -1)
+            count(deltas, current_values(obj, fields), 1)
+
+
+@event.listens_for(RoutingSession, 'before_commit')
+def write(session):
+    session.flush()
+    deltas = session.info.pop('stat_deltas', None)
+    if not deltas:
+        return
+
+    connection = session.connection(mapper=inspect(Stat))
+    count_genres(connection, deltas)
+    rows = [
+        {'scope': scope, 'key': key, 'name': name, 'value': value}
+        for (scope, key, name), value in sorted(deltas.items()) if value
+    ]
+    if not rows:
+        return
+
+    # sorted so concurrent commits lock the counter rows in the same order
+    table = Stat.__table__
+    if connection.dialect.name == 'postgresql':
+        statement = insert(table).values(rows)
+        statement = statement.on_conflict_do_update(
+            index_elements=['scope', 'key', 'name'],
+            set_={'value': table.c.value + statement.excluded.value})
+        connection.execute(statement)
+        return
+
+    # other databases (sqlite in tests and benchmarks) get one row at a time
+    for row in rows:
+        updated = connection.execute(table.update().where(
+            (table.c.scope == row['scope']) & (table.c.key == row['key']) & (table.c.name == row['name'])
+        ).values(value=table.c.value + row['value']))
+        if updated.rowcount == 0:
+            connection.execute(table.insert().values(**row))
+
+
+@event.listens_for(RoutingSession, 'after_rollback')
+def discard(session):
+    session.info.pop('stat_deltas', None)
+
+
+def counters(scope, key=None):
+    query = Stat.query.filter(Stat.scope == scope)
+    if key is not None:
+        query = query.filter(Stat.key == key)
+
+    grouped = {}
+    for stat in query:
+        grouped.setdefault(stat.key, Counter())[stat.name] = stat.value
+    return grouped
+
+
+def ratio(numerator, denominator):
+    if not denominator:
+        return None
+    return numerator / denominator
+
+
+def game_summary(c):
+    return {
+        'games': c['games'],
+        'completed': c['completed'],
+        'completion_rate': ratio(c['completed'], c['games']),
+        'average_rating': ratio(c['rating_sum'], c['rated']),
+        'rating_histogram': {
+            name.split(':')[1]: value for name, value in c.items() if name.startswith('rating:') and value
+        }
+    }
+
+
+def character_summary(c):
+    return {
+        'characters': c['characters'],
+        'good': c['good'],
+        'evil': c['characters'] - c['good'],
+        'average_fighting': ratio(c['fighting_sum'], c['fighting_count']),
+        'average_intelligence': ratio(c['intelligence_sum'], c['intelligence_count'])
+    }
+
+
+def rebuild():
+    # one-off full scan, for databases that had data before the counters
+    Stat.query.filter(Stat.scope.in_(('all', 'genre', 'game'))).delete(synchronize_session=False)
+    deltas = pending(db.session())
+    for model, (fields, count) in COUNTERS.items():
+        columns = [getattr(model, field) for field in fields]
+        for row in stream(model.query.with_entities(*columns), model):
+            count(deltas, dict(zip(fields, row)), 1)
+    db.session.commit()
@@ -0,0 +1,192 @@
+import atexit
+import os
+import threading
+from collections import OrderedDict
+
+from flask import current_app
+from sqlalchemy import exc
+
+from cache import get_cache
+from changes import track_upserts
+from models import db, update_if_version, Game
+from stats import track_rows, GAME_FIELDS
+
+DEFAULT_WRITE_BEHIND_MAX_BATCH = 500
+DEFAULT_WRITE_BEHIND_INTERVAL = 0.1
+
+
+def last_write_wins(previous, values):
+    return dict(previous, **values)
+
+
+class UpdateQueue:
+    '''
+    Game updates accepted by PATCH in write-behind mode. Updates to the same
+    game are merged while they wait, and a background thread writes them in
+    batches of up to max_batch rows per transaction, every interval seconds
+    or as soon as a batch is full. close() (also run at exit) writes out
+    whatever is still queued. A batch that fails is written again one row
+    at a time: a row that fails on its own is dropped, and only when the
+    database itself is failing are the rows queued again.
+    '''
+
+    def __init__(self, app, max_batch=DEFAULT_WRITE_BEHIND_MAX_BATCH, interval=DEFAULT_WRITE_BEHIND_INTERVAL,
+                 merge=last_write_wins):
+        self.app = app
+        self.max_batch = max_batch
+        self.interval = interval
+        self.merge = merge
+        self.pending = OrderedDict()
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+        self.flush_lock = threading.Lock()
+        self.thread = None
+        self.closed = False
+        self.counts = {
+            'accepted': 0, 'coalesced': 0, 'written': 0, 'missing': 0, 'dropped': 0, 'batches': 0, 'failures': 0}
+
+    def add(self, game_id, values):
+        # False once the queue is closed, the caller then writes directly
+        with self.lock:
+            if self.closed:
+                return False
+            if self.thread is None:
+                self.start()
+            if game_id in self.pending:
+                values = self.merge(self.pending[game_id], values)
+                self.counts['coalesced'] += 1
+            self.pending[game_id] = values
+            self.counts['accepted'] += 1
+            if len(self.pending) >= self.max_batch:
+                self.wakeup.notify()
+        return True
+
+    def start(self):
+        # started by the first update rather than at app creation, so
+        # nothing runs in processes that never take a write
+        self.thread = threading.Thread(target=self.run, name='write-behind', daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def run(self):
+        while True:
+            with self.lock:
+                if not self.closed and len(self.pending) < self.max_batch:
+                    self.wakeup.wait(self.interval)
+                if self.closed:
+                    return
+            self.flush()
+
+    def take(self):
+        with self.lock:
+            batch = OrderedDict()
+            while self.pending and len(batch) < self.max_batch:
+                game_id, values = self.pending.popitem(last=False)
+                batch[game_id] = values
+            return batch
+
+    def requeue(self, batch):
+        # updates that arrived in the meantime are newer and merge on top
+        with self.lock:
+            for game_id, values in batch.items():
+                if game_id in self.pending:
+                    values = self.merge(values, self.pending[game_id])
+                self.pending[game_id] = values
+                self.pending.move_to_end(game_id, last=False)
+
+    def flush(self):
+        with self.flush_lock:
+            while True:
+                batch = self.take()
+                if not batch:
+                    return
+                retry = self.write(batch)
+                if retry:
+                    self.requeue(retry)
+                    return
+
+    def write(self, batch):
+        # the updates that have to be queued again, if any
+        with self.app.app_context():
+            try:
+                self.commit(batch)
+            except Exception:
+                db.session.rollback()
+                current_app.logger.exception('write-behind batch of %d updates failed', len(batch))
+                with self.lock:
+                    self.counts['failures'] += 1
+                return self.write_each(batch)
+            finally:
+                cache = get_cache()
+                if cache is not None:
+                    cache.invalidate('games')
+        return None
+
+    def write_each(self, batch):
+        for position, game_id in enumerate(sorted(batch)):
+            try:
+                self.commit({game_id: batch[game_id]})
+            except (exc.OperationalError, exc.DisconnectionError, exc.TimeoutError):
+                # the database is unreachable or overloaded, not this row
+                db.session.rollback()
+                return OrderedDict((id, batch[id]) for id in sorted(batch)[position:])
+            except Exception:
+                db.session.rollback()
+                current_app.logger.exception('write-behind update of game %s dropped', game_id)
+                with self.lock:
+                    self.counts['dropped'] += 1
+        return None
+
+    def commit(self, batch):
+        # one transaction per batch; ids sorted so concurrent batches and
+        # requests lock the rows in the same order
+        written = missing = 0
+        for game_id in sorted(batch):
+            result = update_if_version(Game, game_id, None, batch[game_id], ('title',) + GAME_FIELDS)
+            if result is None:
+                missing += 1
+                continue
+            previous, current, version = result
+            track_rows(Game, [previous], -1)
+            track_rows(Game, [current])
+            track_upserts(Game, [dict(current, id=game_id, version=version)])
+            written += 1
+        db.session.commit()
+
+        with self.lock:
+            self.counts['written'] += written
+            self.counts['missing'] += missing
+            self.counts['batches'] += 1
+
+    def close(self):
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.wakeup.notify()
+        if self.thread is not None:
+            self.thread.join()
+        self.flush()
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counts, depth=len(self.pending))
+
+
+def setup_write_behind(app):
+    app.config.setdefault('WRITE_BEHIND', os.environ.get('WRITE_BEHIND', 'false').lower() == 'true')
+    app.config.setdefault('WRITE_BEHIND_MAX_BATCH', int(os.environ.get('WRITE_BEHIND_MAX_BATCH', DEFAULT_WRITE_BEHIND_MAX_BATCH)))
+    app.config.setdefault('WRITE_BEHIND_INTERVAL', float(os.environ.get('WRITE_BEHIND_INTERVAL', DEFAULT_WRITE_BEHIND_INTERVAL)))
+    app.config.setdefault('WRITE_BEHIND_MERGE', last_write_wins)
+
+    queue = None
+    if app.config['WRITE_BEHIND']:
+        queue = UpdateQueue(
+            app, max_batch=app.config['WRITE_BEHIND_MAX_BATCH'], interval=app.config['WRITE_BEHIND_INTERVAL'],
+            merge=app.config['WRITE_BEHIND_MERGE'])
+    app.extensions['write_behind'] = queue
+    return queue
+
+
+def get_queue():
+    return current_app.extensions.get('write_behind')
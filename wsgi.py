@@ -0,0 +1,11 @@
+'''
+Serving entry point:
+
+    gunicorn wsgi:app
+
+Builds the app once per worker and nothing else; the migration tooling is
+only loaded by manage.py, the flask command's entry point.
+'''
+from app import create_app
+
+app = create_app()